@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Compare payload sizes and encode/decode times of the agent protocol messages in JSON and the binary encodings, and
+the cost of building a task response from stored task data by decoding and encoding it again or by splicing it in
+as is.
+
+    python benchmarks/encoding_benchmark.py --number 1000 --tasks 5
+"""
+import argparse
+import json
+import timeit
+import uuid
+
+from slamon_afm.encoding import BINARY_ENCODINGS, RawJSON, json_dumps
+
+
+def task_response(tasks):
+    return {
+        'tasks': [{
+            'task_id': str(uuid.uuid4()),
+            'task_type': 'http',
+            'task_version': 1,
+            'task_data': {
+                'url': 'http://example.com/',
+                'timeout': 30,
+                'headers': {'X-Probe-{}'.format(i): 'value {}'.format(i) for i in range(20)},
+                'expect': [{'status': 200, 'latency_ms': 500, 'contains': 'x' * 64} for _ in range(10)]
+            }
+        } for _ in range(tasks)],
+        'return_time': '2015-04-23T18:25:43.511000+03:00',
+        'capabilities_hash': '3bd8e2ba7bd5d7b3d95d64b6fbfd24a3c7c2bd10'
+    }
+
+
+def task_result():
+    return {
+        'protocol': 1,
+        'task_id': str(uuid.uuid4()),
+        'task_data': {
+            'samples': [{'time': 1429802743.511 + i, 'latency_ms': 123.456 + i, 'status': 200, 'bytes': 10240}
+                        for i in range(100)]
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Agent protocol encoding benchmark')
+    parser.add_argument('--number', type=int, default=1000, help='Encodings and decodings per measurement')
+    parser.add_argument('--tasks', type=int, default=5, help='Tasks per task response')
+    args = parser.parse_args()
+
+    encodings = [('json', (lambda data: json.loads(data.decode('utf-8')),
+                           lambda obj: json.dumps(obj).encode('utf-8')))]
+    encodings += [(mimetype.split('/')[1], encoding) for mimetype, encoding in sorted(BINARY_ENCODINGS.items())
+                  if encoding]
+
+    print('{:<16} {:<10} {:>10} {:>12} {:>12}'.format('message', 'encoding', 'bytes', 'encode us', 'decode us'))
+    for name, message in [('task response', task_response(args.tasks)), ('task result', task_result())]:
+        for encoding_name, (decode, encode) in encodings:
+            encoded = encode(message)
+            encode_time = timeit.timeit(lambda: encode(message), number=args.number)
+            decode_time = timeit.timeit(lambda: decode(encoded), number=args.number)
+            print('{:<16} {:<10} {:>10} {:>12.1f} {:>12.1f}'.format(name, encoding_name, len(encoded),
+                                                                    encode_time / args.number * 1e6,
+                                                                    decode_time / args.number * 1e6))
+
+    # task data is stored as compact JSON text
+    message = task_response(args.tasks)
+    stored = [json.dumps(task['task_data'], separators=(',', ':')) for task in message['tasks']]
+
+    def decoded():
+        tasks = [dict(task, task_data=json.loads(data)) for task, data in zip(message['tasks'], stored)]
+        return json.dumps(dict(message, tasks=tasks))
+
+    def spliced():
+        tasks = [dict(task, task_data=RawJSON(data)) for task, data in zip(message['tasks'], stored)]
+        return json_dumps(dict(message, tasks=tasks))
+
+    print()
+    print('{:<32} {:>12}'.format('task response from stored data', 'us'))
+    for name, build in [('decode and encode', decoded), ('splice', spliced)]:
+        print('{:<32} {:>12.1f}'.format(name, timeit.timeit(build, number=args.number) / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Compare the per-request logging overhead paid by request threads when assigning tasks to an agent: eagerly
+formatted messages written by a synchronous file handler, and lazily formatted messages passed to the queue
+handler used by AFM, with and without payload logging.
+
+    python benchmarks/logging_benchmark.py --number 10000 --tasks 5
+"""
+import argparse
+import logging
+import os.path
+import shutil
+import tempfile
+import timeit
+import uuid
+from logging.handlers import QueueListener
+from queue import Queue
+
+from slamon_afm.app import DefaultConfig
+from slamon_afm.logs import LocalQueueHandler
+
+
+def synchronous_logger(path):
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(DefaultConfig.LOG_FORMAT))
+    logger = logging.getLogger('benchmark.synchronous')
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger, None
+
+
+def queued_logger(path):
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(DefaultConfig.LOG_FORMAT))
+    queue = Queue()
+    listener = QueueListener(queue, handler)
+    listener.start()
+    logger = logging.getLogger('benchmark.queued')
+    logger.addHandler(LocalQueueHandler(queue))
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger, listener
+
+
+def eager(logger, tasks, agent_uuid):
+    logger.info("Assigning tasks {} to agent {}, {}".format([task['task_id'] for task in tasks], 'Agent',
+                                                            agent_uuid))
+    logger.debug("Task details: {}".format(tasks))
+
+
+def lazy(logger, tasks, agent_uuid, log_payloads):
+    logger.info("Assigning tasks %s to agent %s, %s", [task['task_id'] for task in tasks], 'Agent', agent_uuid)
+    if log_payloads:
+        logger.debug("Task details: %s", tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logging overhead benchmark')
+    parser.add_argument('--number', type=int, default=10000, help='Logged requests per measurement')
+    parser.add_argument('--tasks', type=int, default=5, help='Tasks assigned per request')
+    args = parser.parse_args()
+
+    agent_uuid = str(uuid.uuid4())
+    tasks = [{'task_id': str(uuid.uuid4()), 'task_type': 'wait', 'task_version': 1,
+              'task_data': {'wait_time': 3600, 'url': 'http://example.com/' + 'x' * 200}} for _ in range(args.tasks)]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sync_logger, _ = synchronous_logger(os.path.join(tmp_dir, 'sync.log'))
+        queue_logger, listener = queued_logger(os.path.join(tmp_dir, 'queued.log'))
+
+        cases = [
+            ('eager, synchronous', lambda: eager(sync_logger, tasks, agent_uuid)),
+            ('lazy, queued, payloads', lambda: lazy(queue_logger, tasks, agent_uuid, True)),
+            ('lazy, queued', lambda: lazy(queue_logger, tasks, agent_uuid, False)),
+        ]
+
+        print('{:<24} {:>12}'.format('logging', 'us/request'))
+        for name, case in cases:
+            elapsed = timeit.timeit(case, number=args.number)
+            print('{:<24} {:>12.1f}'.format(name, elapsed / args.number * 1e6))
+
+        listener.stop()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Measure concurrent agent polls and BPMS reads against a file SQLite database, with the default engine settings
+(WAL journal, synchronous=NORMAL, busy timeout and pooled connections) and with the SQLite defaults.
+
+    python benchmarks/sqlite_benchmark.py --workers 4 --readers 2 --tasks 2000
+"""
+from multiprocessing import Event, Process, Queue
+import argparse
+import logging
+import os.path
+import shutil
+import tempfile
+import time
+import uuid
+
+from sqlalchemy.pool import NullPool
+from webtest import TestApp
+
+from slamon_afm.app import create_app
+from slamon_afm.models import db, Task
+
+TEST_ID = 'de305d54-75b4-431b-adb2-eb6b9e546013'
+
+# SQLite defaults: rollback journal, synchronous=FULL, a new connection for every request
+UNTUNED = {
+    'SQLITE_JOURNAL_MODE': None,
+    'SQLITE_SYNCHRONOUS': None,
+    'SQLITE_BUSY_TIMEOUT': None,
+    'SQLALCHEMY_ENGINE_OPTIONS': {'poolclass': NullPool}
+}
+
+# polling processes give up after this many failed polls in a row
+MAX_CONSECUTIVE_FAILURES = 100
+
+
+def _app(database_uri, config):
+    return create_app(config=dict(config, SQLALCHEMY_DATABASE_URI=database_uri, AUTO_CREATE=False,
+                                  LOG_LEVEL=logging.WARNING))
+
+
+def poll(database_uri, config, max_tasks, results):
+    test_app = TestApp(_app(database_uri, config))
+    agent_uuid = str(uuid.uuid4())
+
+    latencies, claimed, errors, consecutive_errors = [], 0, 0, 0
+    while consecutive_errors < MAX_CONSECUTIVE_FAILURES:
+        start = time.perf_counter()
+        resp = test_app.post_json('/tasks', {
+            'protocol': 1,
+            'agent_id': agent_uuid,
+            'agent_name': 'Benchmark agent',
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {'benchmark': {'version': 1}},
+            'max_tasks': max_tasks
+        }, expect_errors=True)
+        latencies.append(time.perf_counter() - start)
+        if resp.status_int != 200:
+            errors += 1
+            consecutive_errors += 1
+            continue
+        consecutive_errors = 0
+        if not resp.json['tasks']:
+            break
+        claimed += len(resp.json['tasks'])
+
+    results.put((latencies, claimed, errors, consecutive_errors >= MAX_CONSECUTIVE_FAILURES))
+
+
+def read(database_uri, config, done, results):
+    test_app = TestApp(_app(database_uri, config))
+
+    reads, errors = 0, 0
+    while not done.is_set():
+        resp = test_app.get('/task', {'test_id': TEST_ID, 'limit': 100}, expect_errors=True)
+        if resp.status_int == 200:
+            reads += 1
+        else:
+            errors += 1
+
+    results.put((reads, errors))
+
+
+def measure(database_uri, config, args):
+    app = _app(database_uri, config)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Task.__table__.insert(), [
+            {'uuid': str(uuid.uuid4()), 'test_id': TEST_ID, 'type': 'benchmark', 'version': 1, 'data': {}}
+            for _ in range(args.tasks)])
+        db.session.commit()
+        db.session.remove()
+
+    poll_results, read_results, done = Queue(), Queue(), Event()
+    pollers = [Process(target=poll, args=(database_uri, config, args.max_tasks, poll_results))
+               for _ in range(args.workers)]
+    readers = [Process(target=read, args=(database_uri, config, done, read_results)) for _ in range(args.readers)]
+    start = time.perf_counter()
+    for process in pollers + readers:
+        process.start()
+    polls = [poll_results.get() for _ in pollers]
+    elapsed = time.perf_counter() - start
+    done.set()
+    reads = [read_results.get() for _ in readers]
+    for process in pollers + readers:
+        process.join()
+
+    latencies = sorted(latency for poll_latencies, _, _, _ in polls for latency in poll_latencies)
+    return {
+        'elapsed': elapsed,
+        'claimed': sum(claimed for _, claimed, _, _ in polls),
+        'polls': len(latencies),
+        'failed_polls': sum(errors for _, _, errors, _ in polls),
+        'gave_up': sum(gave_up for _, _, _, gave_up in polls),
+        'median': latencies[len(latencies) // 2],
+        'p99': latencies[int(len(latencies) * 0.99)],
+        'reads': sum(count for count, _ in reads),
+        'failed_reads': sum(errors for _, errors in reads)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent polls against file SQLite benchmark')
+    parser.add_argument('--workers', type=int, default=4, help='Number of polling processes')
+    parser.add_argument('--readers', type=int, default=2, help='Number of processes reading tasks through BPMS API')
+    parser.add_argument('--tasks', type=int, default=2000, help='Number of tasks to claim')
+    parser.add_argument('--max-tasks', type=int, default=5, help='Tasks claimed per poll')
+    args = parser.parse_args()
+
+    print('{:<10} {:>10} {:>10} {:>12} {:>10} {:>10} {:>10} {:>12}'.format(
+        'settings', 'tasks/s', 'polls/s', 'failed polls', 'median ms', 'p99 ms', 'reads/s', 'failed reads'))
+    for name, config in (('untuned', UNTUNED), ('tuned', {})):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            result = measure('sqlite:///' + os.path.join(tmp_dir, 'benchmark.db'), config, args)
+        finally:
+            shutil.rmtree(tmp_dir)
+        print('{:<10} {:>10.0f} {:>10.0f} {:>12} {:>10.1f} {:>10.1f} {:>10.0f} {:>12}'.format(
+            name, result['claimed'] / result['elapsed'], result['polls'] / result['elapsed'], result['failed_polls'],
+            result['median'] * 1000, result['p99'] * 1000, result['reads'] / result['elapsed'],
+            result['failed_reads']))
+        if result['gave_up']:
+            print('{:<10} {} of {} polling processes gave up after {} consecutive failed polls, {} of {} tasks '
+                  'claimed'.format(name, result['gave_up'], args.workers, MAX_CONSECUTIVE_FAILURES,
+                                   result['claimed'], args.tasks))
+
+
+if __name__ == '__main__':
+    main()
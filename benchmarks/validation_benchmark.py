@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Compare per-request JSON schema validation cost of jsonschema.validate() and the precompiled validators.
+
+    python benchmarks/validation_benchmark.py --number 10000
+"""
+import argparse
+import timeit
+
+import jsonschema
+
+from slamon_afm.routes.agent_routes import TASK_REQUEST_SCHEMA, TASK_REQUEST_VALIDATOR, TASK_RESPONSE_SCHEMA, \
+    TASK_RESPONSE_VALIDATOR
+from slamon_afm.routes.bpms_routes import POST_TASK_SCHEMA, POST_TASK_VALIDATOR
+
+TASK_REQUEST = {
+    'protocol': 1,
+    'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+    'agent_name': 'Agent 007',
+    'agent_location': {
+        'country': 'FI',
+        'region': '18'
+    },
+    'agent_time': '2012-04-23T18:25:43.511Z',
+    'agent_capabilities': {
+        'task-type-1': {'version': 1},
+        'task-type-2': {'version': 2},
+        'task-type-3': {'version': 3}
+    },
+    'max_tasks': 5
+}
+
+TASK_RESPONSE = {
+    'protocol': 1,
+    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+    'task_data': {'key': 'value', 'another_key': 5}
+}
+
+POST_TASK = {
+    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+    'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+    'task_type': 'wait',
+    'task_version': 1,
+    'task_data': {'wait_time': 3600}
+}
+
+CASES = [
+    ('TASK_REQUEST_SCHEMA', TASK_REQUEST_SCHEMA, TASK_REQUEST_VALIDATOR, TASK_REQUEST),
+    ('TASK_RESPONSE_SCHEMA', TASK_RESPONSE_SCHEMA, TASK_RESPONSE_VALIDATOR, TASK_RESPONSE),
+    ('POST_TASK_SCHEMA', POST_TASK_SCHEMA, POST_TASK_VALIDATOR, POST_TASK),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON schema validation benchmark')
+    parser.add_argument('--number', type=int, default=10000, help='Validations per measurement')
+    args = parser.parse_args()
+
+    print('{:<22} {:>16} {:>16} {:>8}'.format('schema', 'validate() us', 'precompiled us', 'speedup'))
+    for name, schema, validator, instance in CASES:
+        before = timeit.timeit(lambda: jsonschema.validate(instance, schema), number=args.number)
+        after = timeit.timeit(lambda: validator.validate(instance), number=args.number)
+        print('{:<22} {:>16.1f} {:>16.1f} {:>7.1f}x'.format(name, before / args.number * 1e6,
+                                                            after / args.number * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
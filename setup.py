@@ -18,12 +18,16 @@ setup(
     packages=find_packages(),
     package_data={'slamon_afm.routes': ['dashboard.html']},
     install_requires=[
-        'sqlalchemy>=1.0.6, <2.0',
+        'sqlalchemy>=1.1, <2.0',
         'jsonschema>=2.5.1, <3.0',
         'python_dateutil>= 2.4.2, <3.0',
         'flask>=0.10',
-        'flask-sqlalchemy>=2.0'
+        'flask-sqlalchemy>=2.4'
     ],
+    extras_require={
+        'server': ['gunicorn>=19.0'],
+        'binary': ['msgpack>=0.5.2', 'cbor2>=4.0']
+    },
     entry_points={
         'console_scripts': [
             'slamon-afm = slamon_afm.cli:main'
@@ -1,7 +1,18 @@
 import logging
 from flask import Flask
+from werkzeug.utils import import_string
 
+from slamon_afm.cache import LRUCache, TimedCache
+from slamon_afm.background import PeriodicJob
+from slamon_afm.counters import PendingTaskCounters
+from slamon_afm.database import engine_options
+from slamon_afm.heartbeats import HeartbeatBuffer
+from slamon_afm.logs import setup_logging
 from slamon_afm.models import db
+from slamon_afm.notifier import TaskNotifier
+from slamon_afm.polling import PollScheduler
+from slamon_afm.reaper import TaskReaper
+from slamon_afm.retention import purge_configured
 from slamon_afm.routes import agent_routes, bpms_routes, status_routes, dashboard_routes
 
 
@@ -10,12 +21,45 @@ class DefaultConfig(object):
     Container for default configuration values
     """
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    DATABASE_POOL_SIZE = None
+    DATABASE_MAX_OVERFLOW = None
+    DATABASE_POOL_PRE_PING = None
+    DATABASE_STATEMENT_CACHE_SIZE = None
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_BUSY_TIMEOUT = 5000
     AGENT_RETURN_TIME = 60
+    AGENT_RETURN_TIME_BUSY = 5
+    AGENT_RETURN_TIME_JITTER = 0.2
+    AGENT_MAX_POLL_RATE = 0
     AGENT_ACTIVE_THRESHOLD = 300
+    AGENT_LONG_POLL_TIMEOUT = 30
+    AGENT_HEARTBEAT_INTERVAL = 10
+    AGENT_CAPABILITY_SETS_MAX = 1024
+    PENDING_TASKS_REFRESH_INTERVAL = 10
+    TASK_BATCH_MAX_SIZE = 1000
+    TASK_QUERY_MAX_LIMIT = 1000
+    TASK_DATA_COMPRESS_THRESHOLD = 1024
+    JSON_DUMPS = None
+    TASK_LEASE_TIME = 86400
+    TASK_REAPER_INTERVAL = 60
+    TASK_REAPER_BATCH_SIZE = 500
+    TASK_RETENTION_DAYS = 0
+    TASK_RETENTION_ARCHIVE = True
+    TASK_RETENTION_INTERVAL = 3600
+    TASK_RETENTION_BATCH_SIZE = 500
+    TASK_CACHE_MAX_ENTRIES = 10000
+    TASK_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    TASK_CACHE_MAX_AGE = 3600
+    STATUS_CACHE_TTL = 5
+    DASHBOARD_PAGE_SIZE = 100
+    DASHBOARD_TASKS_PER_AGENT = 20
+    DASHBOARD_CACHE_TTL = 2
     AUTO_CREATE = True
     LOG_FILE = None
     LOG_LEVEL = logging.DEBUG
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message).120s'
+    LOG_PAYLOADS = False
 
 
 def create_app(config=None, config_file=None):
@@ -33,12 +77,47 @@ def create_app(config=None, config_file=None):
         app.config.update(**config)
 
     # setup logging according to configuration
-    app.logger_name = 'slamon_afm'
-    handler = logging.FileHandler(app.config['LOG_FILE']) if app.config['LOG_FILE'] else logging.StreamHandler()
-    handler.setLevel(app.config['LOG_LEVEL'])
-    handler.setFormatter(logging.Formatter(app.config['LOG_FORMAT']))
-    app.logger.setLevel(app.config['LOG_LEVEL'])
-    app.logger.addHandler(handler)
+    setup_logging(app)
+
+    # engine and connection pool options by backend
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    # JSON encoder for the agent protocol and stored task data
+    app.extensions['json_dumps'] = import_string(app.config['JSON_DUMPS']) if app.config['JSON_DUMPS'] else None
+
+    # in-process notifications for long polling agents and pending task counts for skipping empty polls
+    app.extensions['task_notifier'] = TaskNotifier()
+    app.extensions['pending_tasks'] = PendingTaskCounters(app.config['PENDING_TASKS_REFRESH_INTERVAL'])
+
+    # agent last seen times buffered for bulk writes
+    app.extensions['heartbeats'] = HeartbeatBuffer(app.config['AGENT_HEARTBEAT_INTERVAL'])
+
+    # capability sets by their fingerprints, for agents sending only the fingerprint, bounded by the number of sets
+    app.extensions['capability_sets'] = LRUCache(app.config['AGENT_CAPABILITY_SETS_MAX'],
+                                                 app.config['AGENT_CAPABILITY_SETS_MAX'])
+
+    # return times of polling agents
+    app.extensions['poll_scheduler'] = PollScheduler(app.config['AGENT_RETURN_TIME'],
+                                                     app.config['AGENT_RETURN_TIME_BUSY'],
+                                                     app.config['AGENT_RETURN_TIME_JITTER'],
+                                                     app.config['AGENT_MAX_POLL_RATE'],
+                                                     app.config['AGENT_HEARTBEAT_INTERVAL'])
+
+    # requeue tasks with expired leases and fail tasks with expired TTLs
+    app.extensions['task_reaper'] = TaskReaper(app.config['TASK_REAPER_BATCH_SIZE'])
+    if app.config['TASK_REAPER_INTERVAL']:
+        PeriodicJob(app, 'task-reaper', app.config['TASK_REAPER_INTERVAL'], app.extensions['task_reaper'].sweep)
+
+    # archive or delete old finished tasks
+    if app.config['TASK_RETENTION_DAYS'] and app.config['TASK_RETENTION_INTERVAL']:
+        PeriodicJob(app, 'task-retention', app.config['TASK_RETENTION_INTERVAL'], purge_configured)
+
+    # cached responses of finished tasks
+    app.extensions['task_cache'] = LRUCache(app.config['TASK_CACHE_MAX_ENTRIES'], app.config['TASK_CACHE_MAX_BYTES'])
+
+    # cached stats for /status and dashboard snapshots
+    app.extensions['status_cache'] = TimedCache(app.config['STATUS_CACHE_TTL'])
+    app.extensions['dashboard_cache'] = TimedCache(app.config['DASHBOARD_CACHE_TTL'])
 
     # register app routes
     app.register_blueprint(agent_routes.blueprint)
@@ -0,0 +1,52 @@
+import threading
+
+from slamon_afm.models import db
+
+
+class PeriodicJob(object):
+    """
+    Run a function periodically in a daemon thread within an application context.
+
+    The thread is started by the first request, so that with forking servers it is started in the worker
+    processes instead of the master process.
+    """
+
+    def __init__(self, app, name, interval, func):
+        """
+        :param app: The application to run the job for
+        :param name: Name of the job, used in logs and as the thread name
+        :param interval: Interval between the runs, defined in seconds
+        :param func: The function to run
+        """
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._thread = None
+        self._stopped = threading.Event()
+
+        app.before_first_request(self.start)
+
+    def start(self):
+        """
+        Start running the job, unless it already runs
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop running the job after the current run
+        """
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.func()
+                except Exception:
+                    self.app.logger.exception("Periodic job %s failed", self.name)
+                finally:
+                    db.session.remove()
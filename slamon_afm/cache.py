@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TimedCache(object):
+    """
+    Values cached for a fixed time, optionally by key.
+
+    A value is computed by the first caller after the cached value has expired while other callers wait for it,
+    so each value is computed at most once per ttl seconds no matter how many requests need it.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, compute, key=None):
+        """
+        Get a cached value, computing a new one if the cached value has expired
+
+        :param compute: A function computing the value, exceptions are passed to the caller and not cached
+        :param key: Key of the value
+        :return: The cached value
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is None or now >= entry[1]:
+                # drop all expired values before adding a new one
+                self._entries = {k: e for k, e in self._entries.items() if now < e[1]}
+                entry = self._entries[key] = (compute(), time.monotonic() + self.ttl)
+            return entry[0]
+
+    def invalidate(self):
+        """
+        Expire all cached values
+        """
+        with self._lock:
+            self._entries = {}
+
+
+class LRUCache(object):
+    """
+    Values cached by key, bounded by both the number of entries and their total size. The least recently used
+    entries are evicted first when either of the limits is exceeded.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Get a cached value
+
+        :param key: Key of the value
+        :return: The cached value, or None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Cache a value
+
+        :param key: Key of the value
+        :param value: The value
+        :param size: Size of the value in bytes, values larger than max_bytes are not cached
+        """
+        if not self.max_entries or size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop all cached values
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        :return: A dict of cache statistics
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
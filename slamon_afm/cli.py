@@ -4,7 +4,8 @@ import argparse
 import os.path
 
 from slamon_afm.app import create_app
-from slamon_afm.models import db
+from slamon_afm.models import db, upgrade_tables
+from slamon_afm.retention import purge_tasks
 
 
 def main():
@@ -21,12 +22,38 @@ def main():
                                                    'that listens to given host address')
     run_parser.add_argument('host', type=str, help='Host name or address e.g. localhost or 127.0.0.1')
     run_parser.add_argument('port', type=int, default=8080, nargs='?', help='Listening port, defaults to 8080')
+    run_parser.add_argument('--workers', type=int, default=0,
+                            help='Number of worker processes for production serving with gunicorn, '
+                                 'defaults to 0 for running the development server')
+    run_parser.add_argument('--threads', type=int, default=1, help='Number of threads per worker process')
+    run_parser.add_argument('--keep-alive', type=int, default=5,
+                            help='Seconds to wait for requests on a keep-alive connection')
+    run_parser.add_argument('--graceful-timeout', type=int, default=30,
+                            help='Seconds to wait for workers to finish their requests on reload and shutdown')
+    run_parser.add_argument('--timeout', type=int, default=None,
+                            help='Seconds a worker may be unresponsive before it is restarted, defaults to 30 seconds '
+                                 'more than AGENT_LONG_POLL_TIMEOUT')
     run_parser.set_defaults(func=run_afm)
 
     create_parser = subparsers.add_parser('create-tables', help='Create SQL tables',
                                           description='Create required database tables to PostgreSQL')
     create_parser.set_defaults(func=create)
 
+    upgrade_parser = subparsers.add_parser('upgrade-tables', help='Upgrade SQL tables',
+                                           description='Add missing tables, columns and indexes to an existing '
+                                                       'database without dropping data')
+    upgrade_parser.set_defaults(func=upgrade)
+
+    purge_parser = subparsers.add_parser('purge-tasks', help='Archive or delete old finished tasks',
+                                         description='Move tasks finished more than given number of days ago '
+                                                     'to the archive table, or delete them')
+    purge_parser.add_argument('--days', type=int, default=None,
+                              help='Age of the tasks to purge in days, defaults to TASK_RETENTION_DAYS')
+    purge_parser.add_argument('--delete', action='store_true', help='Delete the tasks instead of archiving them')
+    purge_parser.add_argument('--batch-size', type=int, default=None,
+                              help='Number of tasks purged per transaction, defaults to TASK_RETENTION_BATCH_SIZE')
+    purge_parser.set_defaults(func=purge)
+
     drop_parser = subparsers.add_parser('drop-tables', help='Drop SQL tables',
                                         description='Drop created database tables from PostgreSQL')
     drop_parser.set_defaults(func=drop)
@@ -38,17 +65,51 @@ def main():
         parser.print_help()
         exit(1)
 
-    app = create_app(config_file=os.path.abspath(args.config) if args.config else None)
-
-    if args.database_uri:
-        # override the database URI
-        app.config.update(SQLALCHEMY_DATABASE_URI=args.database_uri)
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': args.database_uri} if args.database_uri else None,
+                     config_file=os.path.abspath(args.config) if args.config else None)
 
     args.func(app, args)
 
 
 def run_afm(app, args):
-    app.run(args.host, args.port)
+    if args.workers > 0:
+        run_production(app, args)
+    else:
+        # threaded to allow serving other requests while long polling agents are waiting for tasks, unless all the
+        # threads would share the single connection to an in memory database
+        app.run(args.host, args.port, threaded=not _in_memory_database(app))
+
+
+def run_production(app, args):
+    try:
+        from slamon_afm.server import AFMServer
+    except ImportError:
+        print('Production serving requires gunicorn, install it with: pip install slamon-afm[server]')
+        exit(1)
+
+    if args.workers > 1 and _in_memory_database(app):
+        print('In memory SQLite database can not be shared between worker processes, use a single worker')
+        exit(1)
+    if args.threads > 1 and _in_memory_database(app):
+        print('In memory SQLite database has a single connection that can not be shared between threads, '
+              'use a single thread')
+        exit(1)
+
+    # threaded workers, so that long polling agents don't block the worker and it keeps notifying the master
+    AFMServer(dict(app.config), {
+        'bind': '{}:{}'.format(args.host, args.port),
+        'worker_class': 'gthread',
+        'workers': args.workers,
+        'threads': args.threads,
+        'keepalive': args.keep_alive,
+        'graceful_timeout': args.graceful_timeout,
+        'timeout': args.timeout if args.timeout is not None else app.config['AGENT_LONG_POLL_TIMEOUT'] + 30
+    }).run()
+
+
+def _in_memory_database(app):
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    return database_uri == 'sqlite://' or database_uri.endswith(':memory:')
 
 
 def create(app, args):
@@ -56,6 +117,23 @@ def create(app, args):
         db.create_all()
 
 
+def upgrade(app, args):
+    with app.app_context():
+        upgrade_tables()
+
+
+def purge(app, args):
+    days = args.days if args.days is not None else app.config['TASK_RETENTION_DAYS']
+    if not days:
+        print('Give the age of the tasks to purge with --days or TASK_RETENTION_DAYS')
+        exit(1)
+
+    with app.app_context():
+        purged = purge_tasks(days, archive=not args.delete and app.config['TASK_RETENTION_ARCHIVE'],
+                             batch_size=args.batch_size or app.config['TASK_RETENTION_BATCH_SIZE'])
+    print('Purged {} tasks'.format(purged))
+
+
 def drop(app, args):
     with app.app_context():
         db.drop_all()
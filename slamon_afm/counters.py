@@ -0,0 +1,101 @@
+import threading
+import time
+
+from sqlalchemy import func
+
+from slamon_afm.models import db, Task
+
+
+class PendingTaskCounters(object):
+    """
+    Cheap to read counts of pending (unclaimed) tasks per (task type, version).
+
+    The counters are incremented when tasks are posted and decremented when tasks are claimed through this process.
+    They are rebuilt from the database on first use and after that every refresh_interval seconds, which bounds the
+    time it takes to notice tasks added or claimed by other AFM processes sharing the database. Refresh interval of
+    0 disables counting, in which case there may always be pending tasks.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._counts = {}
+        self._added_during_rebuild = None
+        self._rebuilt = None
+
+    def rebuild(self):
+        """
+        Rebuild the counters from the database
+        """
+        with self._rebuild_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            self._added_during_rebuild = {}
+
+        try:
+            counts = {(task_type, task_version): count for task_type, task_version, count in
+                      db.session.query(Task.type, Task.version, func.count(Task.uuid)).
+                      filter(Task.PENDING).
+                      group_by(Task.type, Task.version)}
+        finally:
+            with self._lock:
+                added, self._added_during_rebuild = self._added_during_rebuild, None
+
+        with self._lock:
+            # tasks added while querying may or may not be included in the query results, count them in to be on
+            # the safe side as too large counts only cost an unnecessary claim query
+            for key, count in added.items():
+                counts[key] = counts.get(key, 0) + count
+            self._counts = counts
+            self._rebuilt = time.monotonic()
+
+    def add(self, task_type, task_version, count=1):
+        """
+        Count in new pending tasks
+
+        :param task_type: Type of the tasks
+        :param task_version: Version of the tasks
+        :param count: Number of tasks added
+        """
+        key = (task_type, task_version)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + count
+            if self._added_during_rebuild is not None:
+                self._added_during_rebuild[key] = self._added_during_rebuild.get(key, 0) + count
+
+    def remove(self, task_type, task_version, count=1):
+        """
+        Count out tasks that are no longer pending
+
+        :param task_type: Type of the tasks
+        :param task_version: Version of the tasks
+        :param count: Number of tasks removed
+        """
+        key = (task_type, task_version)
+        with self._lock:
+            self._counts[key] = max(0, self._counts.get(key, 0) - count)
+
+    def has_pending(self, capabilities):
+        """
+        Check if there may be pending tasks for any of the given capabilities
+
+        :param capabilities: An iterable of (type, version) pairs
+        :return: False if none of the capabilities has pending tasks
+        """
+        if not self.refresh_interval:
+            # counting disabled
+            return True
+
+        if self._rebuilt is None or time.monotonic() - self._rebuilt >= self.refresh_interval:
+            # refresh unless someone else is already at it
+            if self._rebuild_lock.acquire(self._rebuilt is None):
+                try:
+                    self._rebuild()
+                finally:
+                    self._rebuild_lock.release()
+
+        with self._lock:
+            return any(self._counts.get(key, 0) > 0 for key in capabilities)
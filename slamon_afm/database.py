@@ -0,0 +1,82 @@
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+class AFMSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension that applies the SQLite pragmas given in the 'sqlite_pragmas' engine option to every
+    new connection of the engine.
+    """
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super(AFMSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', lambda dbapi_connection, connection_record:
+                         _apply_pragmas(dbapi_connection, pragmas))
+        return engine
+
+
+def _apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+def engine_options(config):
+    """
+    Engine and connection pool options for the configured database, with defaults depending on the backend. Options
+    set explicitly in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+
+    :param config: The application configuration
+    :return: A dict of options for SQLALCHEMY_ENGINE_OPTIONS
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    pool_size = config['DATABASE_POOL_SIZE']
+    max_overflow = config['DATABASE_MAX_OVERFLOW']
+    pre_ping = config['DATABASE_POOL_PRE_PING']
+    options = {}
+
+    if url.drivername.startswith('sqlite'):
+        in_memory = url.database in (None, '', ':memory:')
+
+        # connections are returned to the pool by whichever thread used them last
+        options['connect_args'] = {'check_same_thread': False}
+        if config['DATABASE_STATEMENT_CACHE_SIZE'] is not None:
+            options['connect_args']['cached_statements'] = config['DATABASE_STATEMENT_CACHE_SIZE']
+
+        if not in_memory:
+            # reuse connections instead of opening the database file for every request
+            options['poolclass'] = QueuePool
+            options['pool_size'] = 5 if pool_size is None else pool_size
+            options['max_overflow'] = 10 if max_overflow is None else max_overflow
+
+        # the lock timeout first, changing the journal mode needs a lock
+        pragmas = [('busy_timeout', config['SQLITE_BUSY_TIMEOUT'])]
+        if not in_memory:
+            pragmas.append(('journal_mode', config['SQLITE_JOURNAL_MODE']))
+        pragmas.append(('synchronous', config['SQLITE_SYNCHRONOUS']))
+        options['sqlite_pragmas'] = [(name, value) for name, value in pragmas if value is not None]
+
+        # there is no server connection to lose
+        options['pool_pre_ping'] = bool(pre_ping)
+    else:
+        if pool_size is not None:
+            options['pool_size'] = pool_size
+        if max_overflow is not None:
+            options['max_overflow'] = max_overflow
+        options['pool_pre_ping'] = pre_ping is None or bool(pre_ping)
+
+    explicit = config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    if 'poolclass' in explicit:
+        # pool sizing may not apply to the chosen pool
+        for name in ('pool_size', 'max_overflow'):
+            if name not in explicit:
+                options.pop(name, None)
+    options.update(explicit)
+    return options
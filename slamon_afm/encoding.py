@@ -0,0 +1,145 @@
+import json
+import re
+import uuid
+
+from flask import Response, abort, current_app, request
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover
+    cbor2 = None
+
+
+class RawJSON(object):
+    """
+    JSON text that is spliced verbatim into encoded JSON documents instead of being decoded and encoded again
+    """
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def decode(self):
+        return json.loads(self.text)
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and other.text == self.text
+
+    def __repr__(self):
+        return 'RawJSON({!r})'.format(self.text)
+
+
+def json_dumps(obj):
+    """
+    Encode an object to compact JSON text with the JSON_DUMPS encoder of the current application, or the standard
+    library json module by default. RawJSON values are spliced in verbatim.
+
+    :param obj: The object to encode
+    :return: JSON text
+    """
+    dumps = current_app.extensions.get('json_dumps') if current_app else None
+
+    raw = []
+    token = uuid.uuid4().hex
+
+    def default(value):
+        if isinstance(value, RawJSON):
+            raw.append(value.text)
+            return '{}:{}'.format(token, len(raw) - 1)
+        raise TypeError('{!r} is not JSON serializable'.format(value))
+
+    if dumps is None:
+        text = json.dumps(obj, separators=(',', ':'), default=default)
+    else:
+        text = dumps(obj, default=default)
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+
+    if raw:
+        text = re.sub('"{}:([0-9]+)"'.format(token), lambda match: raw[int(match.group(1))], text)
+    return text
+
+
+def _raw_to_msgpack(value):
+    if isinstance(value, RawJSON):
+        return value.decode()
+    raise TypeError('{!r} is not serializable'.format(value))
+
+
+def _raw_to_cbor(encoder, value):
+    if isinstance(value, RawJSON):
+        return encoder.encode(value.decode())
+    raise TypeError('{!r} is not serializable'.format(value))
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+
+# Binary encodings by media type as (decode, encode) pairs, the ones whose libraries are not installed are None
+BINARY_ENCODINGS = {
+    MSGPACK: (lambda data: msgpack.unpackb(data, raw=False),
+              lambda obj: msgpack.packb(obj, use_bin_type=True, default=_raw_to_msgpack)) if msgpack else None,
+    CBOR: (cbor2.loads, lambda obj: cbor2.dumps(obj, default=_raw_to_cbor)) if cbor2 else None
+}
+
+# Aliases of the binary media types
+ALIASES = {
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.msgpack': MSGPACK
+}
+
+
+def get_request_data():
+    """
+    Decode the request body according to its Content-Type. JSON is decoded by Flask, and binary encodings with the
+    installed libraries. Requests in binary encodings whose library is not installed are answered with 415.
+
+    :return: The decoded data, or None if the request has no data of a supported media type or it fails to decode
+    """
+    mimetype = ALIASES.get(request.mimetype, request.mimetype)
+    if mimetype not in BINARY_ENCODINGS:
+        return request.get_json(silent=True)
+
+    encoding = BINARY_ENCODINGS[mimetype]
+    if encoding is None:
+        abort(415)
+    try:
+        return encoding[0](request.get_data())
+    except Exception:
+        return None
+
+
+def response_mimetype():
+    """
+    Choose the media type of the response according to the Accept header, defaults to JSON
+
+    :return: The media type
+    """
+    available = [JSON] + [mimetype for mimetype, encoding in BINARY_ENCODINGS.items() if encoding]
+    available += [alias for alias, mimetype in ALIASES.items() if BINARY_ENCODINGS[mimetype]]
+    best = request.accept_mimetypes.best_match(available, default=JSON)
+    return ALIASES.get(best, best)
+
+
+def make_data_response(data, mimetype=None):
+    """
+    Create a response encoding the data in the media type negotiated with the client
+
+    :param data: The data to encode
+    :param mimetype: Media type to use instead of the negotiated one
+    :return: The response
+    """
+    mimetype = mimetype or response_mimetype()
+    if mimetype == JSON:
+        response = Response(json_dumps(data), mimetype=JSON)
+    else:
+        response = Response(BINARY_ENCODINGS[mimetype][1](data), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
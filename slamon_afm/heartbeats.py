@@ -0,0 +1,83 @@
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import bindparam, or_
+
+from slamon_afm.models import db, Agent
+
+
+class HeartbeatBuffer(object):
+    """
+    Buffer for agent last seen times, written to the database in bulk.
+
+    Polls record the time the agent was last seen in memory, and the buffered times are written to the database in
+    one batch by the first request after flush_interval seconds have passed since the previous flush. Readers of
+    last_seen flush the buffer first, but may still miss up to flush_interval seconds of heartbeats buffered by other
+    AFM processes sharing the database. Flush interval of 0 writes every heartbeat right away.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_seen = {}
+        self._flushed = time.monotonic()
+
+    def record(self, agent_uuid, last_seen):
+        """
+        Record an agent heartbeat
+
+        :param agent_uuid: UUID of the agent
+        :param last_seen: Time the agent was seen
+        """
+        with self._lock:
+            self._last_seen[agent_uuid] = last_seen
+
+    def flush_if_due(self):
+        """
+        Flush the buffered heartbeats if flush interval has passed, unless another thread is already flushing
+        """
+        if time.monotonic() - self._flushed >= self.flush_interval and self._flush_lock.acquire(False):
+            try:
+                self._flush()
+            finally:
+                self._flush_lock.release()
+
+    def flush(self):
+        """
+        Flush the buffered heartbeats
+        """
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            last_seen, self._last_seen = self._last_seen, {}
+            self._flushed = time.monotonic()
+
+        if not last_seen:
+            return
+
+        # never move last_seen backwards, other processes may have flushed a later heartbeat
+        table = Agent.__table__
+        statement = table.update(). \
+            where(table.c.uuid == bindparam('b_uuid')). \
+            where(or_(table.c.last_seen.is_(None), table.c.last_seen < bindparam('b_last_seen'))). \
+            values(last_seen=bindparam('b_last_seen'))
+        started = time.monotonic()
+        try:
+            db.session.execute(statement, [{'b_uuid': agent_uuid, 'b_last_seen': seen}
+                                           for agent_uuid, seen in last_seen.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("Failed to flush %d agent heartbeats", len(last_seen))
+            # keep the heartbeats for the next flush unless there are newer ones already
+            with self._lock:
+                for agent_uuid, seen in last_seen.items():
+                    self._last_seen.setdefault(agent_uuid, seen)
+            return
+
+        current_app.logger.debug("Flushed %d agent heartbeats in %.1f ms", len(last_seen),
+                                 (time.monotonic() - started) * 1000)
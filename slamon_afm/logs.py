@@ -0,0 +1,91 @@
+import atexit
+import logging
+import os
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+
+# Handlers of the log listener thread, shared by all applications of the process
+_handlers = ()
+_listener = None
+_listener_pid = None
+_lock = threading.Lock()
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Queue handler passing records to a listener thread of the same process as is.
+
+    Unlike QueueHandler, the records are not formatted before queuing, so that formatting happens in the listener
+    thread. Arguments of log calls must thus not be modified after logging.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class ProcessQueueHandler(LocalQueueHandler):
+    """
+    Queue handler passing records to the log listener thread of the current process.
+
+    The listener thread is started by the first record logged in the process, so processes forked after setting up
+    logging, e.g. gunicorn workers, start a listener thread of their own and processes that never log start none.
+    """
+
+    def __init__(self):
+        super().__init__(None)
+
+    def enqueue(self, record):
+        _process_listener().queue.put_nowait(record)
+
+
+def _process_listener():
+    global _listener, _listener_pid
+    pid = os.getpid()
+    if _listener_pid != pid:
+        with _lock:
+            if _listener_pid != pid:
+                if _listener_pid is None:
+                    # flush queued records on exit
+                    atexit.register(_stop_listener)
+                # the logger level equals the handler level, records reaching the queue are all handled
+                _listener = QueueListener(Queue(), *_handlers)
+                _listener.start()
+                _listener_pid = pid
+    return _listener
+
+
+def _stop_listener():
+    with _lock:
+        if _listener_pid == os.getpid():
+            _listener.stop()
+
+
+def setup_logging(app):
+    """
+    Setup logging of an AFM application according to its configuration.
+
+    Log records are queued by the logging threads and formatted and written to the log file or stream by a
+    background listener thread, so that requests don't wait for log I/O. There is one listener thread per process,
+    writing to the log file or stream configured by the latest application set up.
+
+    :param app: The application
+    """
+    global _handlers
+    handler = logging.FileHandler(app.config['LOG_FILE']) if app.config['LOG_FILE'] else logging.StreamHandler()
+    handler.setLevel(app.config['LOG_LEVEL'])
+    handler.setFormatter(logging.Formatter(app.config['LOG_FORMAT']))
+
+    with _lock:
+        previous, _handlers = _handlers, (handler,)
+        if _listener_pid == os.getpid():
+            _listener.handlers = _handlers
+    for previous_handler in previous:
+        previous_handler.close()
+
+    app.logger_name = 'slamon_afm'
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+    # the logger is shared by all applications of the process
+    for queue_handler in [h for h in app.logger.handlers if isinstance(h, ProcessQueueHandler)]:
+        app.logger.removeHandler(queue_handler)
+    app.logger.addHandler(ProcessQueueHandler())
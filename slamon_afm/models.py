@@ -1,12 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
+import json
+import math
 
 from flask import current_app
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, CHAR, DateTime, String, ForeignKey, PrimaryKeyConstraint, Unicode, and_
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, CHAR, DateTime, Float, String, ForeignKey, PrimaryKeyConstraint, Unicode, \
+    Index, Table, and_, or_, inspect, select, union_all
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import relationship, backref, deferred, undefer
 from sqlalchemy.orm.exc import NoResultFound
 
-db = SQLAlchemy()
+from slamon_afm.database import AFMSQLAlchemy
+from slamon_afm.storage import JSONDocument, json_text
+
+db = AFMSQLAlchemy()
 
 
 class Agent(db.Model):
@@ -15,6 +23,16 @@ class Agent(db.Model):
     uuid = Column('uuid', CHAR(36), primary_key=True, nullable=False)
     name = Column('name', Unicode, nullable=False)
     last_seen = Column('last_seen', DateTime, default=datetime.utcnow)
+    # Fingerprint of the capability set last stored for the agent
+    capabilities_hash = Column('capabilities_hash', CHAR(40), nullable=True)
+    # Location last reported by the agent - NULL if never reported
+    country = Column('country', String(2), nullable=True)
+    region = Column('region', String(4), nullable=True)
+    latitude = Column('latitude', Float, nullable=True)
+    longitude = Column('longitude', Float, nullable=True)
+
+    # Active agents are counted by last_seen
+    __table_args__ = (Index('ix_agents_last_seen', last_seen),)
 
     @staticmethod
     def get_agent(agent_uuid, agent_name):
@@ -28,23 +46,40 @@ class Agent(db.Model):
         try:
             agent = db.session.query(Agent).filter(Agent.uuid == agent_uuid).one()
         except NoResultFound:
-            current_app.logger.debug('Registering new agent {0}'.format(agent_uuid))
+            current_app.logger.debug('Registering new agent %s', agent_uuid)
             agent = Agent(uuid=agent_uuid, name=agent_name)
             db.session.add(agent)
         return agent
 
+    @staticmethod
+    def capabilities_fingerprint(agent_capabilities):
+        """
+        Calculate a fingerprint identifying a capability set
+
+        :param agent_capabilities: A dict describing the capability set
+        :return: Fingerprint as a hex string
+        """
+        canonical = json.dumps(sorted((name, int(info['version'])) for name, info in agent_capabilities.items()))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
     def update_capabilities(self, agent_capabilities):
         """
-        Update capabilities of the agent to match the new definitions in agent_capabilities
+        Update capabilities of the agent to match the new definitions in agent_capabilities. Nothing is loaded or
+        written if the fingerprint of the new capability set matches the stored one.
 
         :param agent_capabilities: A dict describing the new capability set
         """
 
+        fingerprint = Agent.capabilities_fingerprint(agent_capabilities)
+        if fingerprint == self.capabilities_hash:
+            return
+        self.capabilities_hash = fingerprint
+
         # format capabilities list as a dict of (name,version) pairs
         new_capabilities = {name: int(info['version']) for name, info in agent_capabilities.items()}
 
         # Update existing capabilities
-        for capability in self.capabilities:
+        for capability in list(self.capabilities):
             if capability.type in new_capabilities:
                 capability.version = new_capabilities[capability.type]
                 del new_capabilities[capability.type]
@@ -60,6 +95,38 @@ class Agent(db.Model):
                 )
             )
 
+    def update_location(self, agent_location):
+        """
+        Update location of the agent, nothing is written if the location is unchanged.
+
+        :param agent_location: A dict with the country and region codes, and optionally the latitude and longitude
+        """
+        location = {
+            'country': agent_location['country'].upper(),
+            'region': agent_location['region'].upper(),
+            'latitude': agent_location.get('latitude'),
+            'longitude': agent_location.get('longitude')
+        }
+        for name, value in location.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+
+    def location_keys(self):
+        """
+        Location keys of the tasks the agent may claim: untargeted tasks, tasks targeting the agent's country or
+        region, and tasks targeting a radius if the agent has reported its coordinates.
+
+        :return: A list of location keys
+        """
+        keys = [Task.ANYWHERE]
+        if self.country:
+            keys.append(Task.location_key(self.country))
+            if self.region:
+                keys.append(Task.location_key(self.country, self.region))
+        if self.latitude is not None and self.longitude is not None:
+            keys.append(Task.WITHIN_RADIUS)
+        return keys
+
 
 class AgentCapability(db.Model):
     __tablename__ = 'agent_capabilities'
@@ -81,10 +148,22 @@ class Task(db.Model):
     type = Column('type', String)
     version = Column('version', Integer)
 
-    # Data that goes to agent with the task
-    data = Column('data', String)  # TODO - use json blob with psql
-    # Data that was returned from agent
-    result_data = Column('result_data', String)  # TODO - use json blob with psql
+    # Tasks with higher priority are claimed first
+    priority = Column('priority', Integer, nullable=False, default=0, server_default='0')
+
+    # Where the task must be run: ANYWHERE, a country or region key (see location_key) or WITHIN_RADIUS kilometers
+    # of the target coordinates
+    location = Column('location', String(7), nullable=False, default='', server_default='')
+    target_latitude = Column('target_latitude', Float, nullable=True)
+    target_longitude = Column('target_longitude', Float, nullable=True)
+    target_radius = Column('target_radius', Float, nullable=True)
+
+    # Data that goes to agent with the task, loaded only when accessed
+    data = deferred(Column('data', JSONDocument))
+    # The same data as JSON text, for passing it on to agents without decoding
+    data_json = deferred(json_text(data.columns[0]).label('data_json'))
+    # Data that was returned from agent, loaded only when accessed
+    result_data = deferred(Column('result_data', JSONDocument))
 
     # Agent that has been assigned to take care of the task - NULL if not claimed yet
     assigned_agent_uuid = Column('assigned_agent_uuid', CHAR(36), ForeignKey('agents.uuid'))
@@ -100,23 +179,225 @@ class Task(db.Model):
     failed = Column('started', DateTime, nullable=True)
     # Error message that should only be present if failed is set
     error = Column('error', Unicode, nullable=True)
+    # When does the claim of the agent expire and the task get requeued - NULL if not claimed or already finished
+    lease_expires = Column('lease_expires', DateTime, nullable=True)
+    # When does the task fail if not claimed before - NULL if no TTL or already finished
+    expires = Column('expires', DateTime, nullable=True)
+
+    # Condition of tasks waiting to be claimed, tasks failed on TTL expiry were never assigned to an agent
+    PENDING = and_(assigned_agent_uuid.is_(None), completed.is_(None), failed.is_(None))
+
+    __table_args__ = (
+        # Claiming looks up pending tasks by type, version and location in claiming order, the index only covers the
+        # pending tasks on backends supporting partial indexes
+        Index('ix_tasks_pending_by_location', type, version, location, priority.desc(), created,
+              postgresql_where=PENDING, sqlite_where=PENDING),
+        # BPMS looks up tasks by test, pages ordered by uuid
+        Index('ix_tasks_test_id', test_id, uuid),
+        # Tasks of an agent
+        Index('ix_tasks_assigned_agent_uuid', assigned_agent_uuid),
+        # Reaper looks up expired leases and TTLs, both are cleared when the task finishes
+        Index('ix_tasks_lease_expires', lease_expires),
+        Index('ix_tasks_expires', expires),
+        # Retention looks up old finished tasks
+        Index('ix_tasks_completed', completed),
+        Index('ix_tasks_failed', failed),
+    )
+
+    # Order in which pending tasks are claimed
+    CLAIM_ORDER = (priority.desc(), created)
+
+    # Location keys of tasks that may be run by any agent and tasks targeting a radius
+    ANYWHERE = ''
+    WITHIN_RADIUS = '@'
+
+    # Kilometers per degree of latitude
+    KM_PER_DEGREE = 111.2
+
+    @staticmethod
+    def location_key(country, region=None):
+        """
+        Location key of tasks targeting a country or a region of a country, e.g. 'FI' or 'FI-18'
+        """
+        return country.upper() + '-' + region.upper() if region else country.upper()
 
     @staticmethod
-    def claim_tasks(agent, max_tasks):
+    def claim_tasks(agent, max_tasks, capabilities=None):
         """
-        Claim tasks to be handled by an agent.
+        Claim tasks to be handled by an agent, the tasks with highest priority first and the oldest first within the
+        same priority. Tasks targeting a location are only claimed by agents in that location.
+
+        Claiming is atomic even when several AFM processes share the same database: on PostgreSQL the candidate
+        rows are locked with FOR UPDATE SKIP LOCKED, on other backends each task is claimed with a conditional
+        UPDATE that only succeeds if no other agent has claimed the task in the meanwhile. Claimed tasks are leased
+        to the agent for TASK_LEASE_TIME seconds, tasks whose TTL has expired are not claimed.
 
         :param agent: The agent to assign tasks to
         :param max_tasks: Maximum number of tasks to assign
+        :param capabilities: (type, version) pairs of the agent's capabilities, defaults to the stored capabilities
         :return: A generator enumerating assigned tasks
         """
-        query = db.session.query(AgentCapability, Task).filter(Task.assigned_agent_uuid.is_(None)). \
-            filter(AgentCapability.agent_uuid == agent.uuid). \
-            filter(and_(AgentCapability.type == Task.type, AgentCapability.version == Task.version))
+        if capabilities is None:
+            capabilities = [(capability.type, capability.version) for capability in agent.capabilities]
+
+        lease_time = current_app.config['TASK_LEASE_TIME']
+        lease = timedelta(seconds=lease_time) if lease_time else None
+        claim = Task._claim_locked if db.engine.dialect.name == 'postgresql' else Task._claim_conditional
+
+        attempted = set()
+        claimed = 0
+        while claimed < max_tasks:
+            candidates = Task._candidates(agent, capabilities, max_tasks - claimed, attempted)
+            if not candidates:
+                break
+            attempted.update(candidates)
+
+            for task in claim(candidates, agent, lease):
+                current_app.logger.info("Claiming task %s for agent %s", task.uuid, agent.uuid)
+                claimed += 1
+                yield task
+
+    @staticmethod
+    def _candidates(agent, capabilities, max_tasks, excluded):
+        """
+        Look up the next pending tasks to claim. Each capability and location key the agent matches is looked up with
+        its own subquery, which is a range scan over the pending task index in claiming order, and the results of the
+        subqueries are merged.
+
+        :return: UUIDs of the candidate tasks in claiming order
+        """
+        now = datetime.utcnow()
+        subqueries = []
+        for task_type, task_version in capabilities:
+            for key in agent.location_keys():
+                query = select([Task.uuid, Task.priority, Task.created]). \
+                    where(and_(Task.type == task_type, Task.version == task_version, Task.location == key)). \
+                    where(Task.PENDING). \
+                    where(or_(Task.expires.is_(None), Task.expires > now))
+                if key == Task.WITHIN_RADIUS:
+                    query = query.where(Task._within_radius(agent.latitude, agent.longitude))
+                if excluded:
+                    query = query.where(~Task.uuid.in_(excluded))
+                subqueries.append(select([query.order_by(*Task.CLAIM_ORDER).limit(max_tasks).alias()]))
+
+        if not subqueries:
+            return []
+        candidates = db.session.execute(union_all(*subqueries) if len(subqueries) > 1 else subqueries[0]).fetchall()
+        candidates.sort(key=lambda task: (-task.priority, task.created))
+        return [task.uuid for task in candidates[:max_tasks]]
+
+    @staticmethod
+    def has_candidates(agent, capabilities, excluded=()):
+        """
+        Check if there are pending tasks the agent could claim, taking the locations the tasks target into account
 
-        # Assign available tasks to the agent and mark them as being in process
-        for _, task in query[0:max_tasks]:
-            current_app.logger.info("Claiming task {} for agent {}".format(task.uuid, agent.uuid))
+        :param agent: The agent
+        :param capabilities: (type, version) pairs of the agent's capabilities
+        :param excluded: UUIDs of tasks not to count, e.g. tasks claimed in the current transaction
+        :return: True if there are pending tasks for the agent
+        """
+        return bool(Task._candidates(agent, capabilities, 1, excluded))
+
+    @staticmethod
+    def _within_radius(latitude, longitude):
+        """
+        Condition matching tasks whose target radius covers the given coordinates. Distances are approximated by
+        projecting the coordinates on a plane at the given latitude, which is accurate enough for radiuses up to a
+        few hundred kilometers.
+        """
+        dy = (Task.target_latitude - latitude) * Task.KM_PER_DEGREE
+        dx = (Task.target_longitude - longitude) * (Task.KM_PER_DEGREE * math.cos(math.radians(latitude)))
+        return dx * dx + dy * dy <= Task.target_radius * Task.target_radius
+
+    @staticmethod
+    def _claim_locked(candidates, agent, lease):
+        """
+        Claim tasks by locking the candidate rows, rows locked by concurrent claims are skipped.
+        """
+        for task in db.session.query(Task).options(undefer(Task.data_json)). \
+                filter(Task.uuid.in_(candidates)). \
+                filter(Task.PENDING). \
+                order_by(*Task.CLAIM_ORDER). \
+                with_for_update(skip_locked=True):
             task.assigned_agent_uuid = agent.uuid
             task.claimed = datetime.utcnow()
+            task.lease_expires = task.claimed + lease if lease else None
+            yield task
+
+    @staticmethod
+    def _claim_conditional(candidates, agent, lease):
+        """
+        Claim tasks one by one with an UPDATE conditional to the task still being unassigned. Tasks that were
+        claimed by someone else between the SELECT and the UPDATE are skipped.
+        """
+        tasks = db.session.query(Task).options(undefer(Task.data_json)). \
+            filter(Task.uuid.in_(candidates)). \
+            filter(Task.PENDING). \
+            order_by(*Task.CLAIM_ORDER).all()
+
+        for task in tasks:
+            now = datetime.utcnow()
+            rowcount = db.session.query(Task). \
+                filter(Task.uuid == task.uuid). \
+                filter(Task.assigned_agent_uuid.is_(None), Task.completed.is_(None), Task.failed.is_(None)). \
+                update({Task.assigned_agent_uuid: agent.uuid, Task.claimed: now,
+                        Task.lease_expires: now + lease if lease else None},
+                       synchronize_session='evaluate')
+            if rowcount != 1:
+                current_app.logger.debug("Task %s was claimed concurrently, skipping", task.uuid)
+                continue
             yield task
+
+
+# Finished tasks moved out of the tasks table by the retention policy, archived tasks are not served by the APIs.
+# Server defaults are copied too, so that columns added later can be added to existing archives.
+tasks_archive = Table(
+    'tasks_archive', db.metadata,
+    *[Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+             server_default=column.server_default.arg if column.server_default is not None else None)
+      for column in Task.__table__.columns] +
+    [Column('archived', DateTime, nullable=False)]
+)
+
+
+# Indexes created by earlier versions that have been replaced by others
+OBSOLETE_INDEXES = {
+    'tasks': ['ix_tasks_pending', 'ix_tasks_pending_priority', 'ix_tasks_pending_location']
+}
+
+
+def upgrade_tables():
+    """
+    Upgrade the tables of an existing database to match the models without dropping data: create missing tables,
+    add missing columns and create missing indexes.
+    """
+    db.create_all()
+
+    engine = db.engine
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                current_app.logger.info("Adding column %s.%s", table.name, column.name)
+                engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    table.name, CreateColumn(column).compile(dialect=engine.dialect)))
+
+        if engine.dialect.name == 'postgresql':
+            # JSON documents were stored as text by earlier versions
+            types = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if isinstance(column.type, JSONDocument) and not isinstance(types.get(column.name), JSONB):
+                    current_app.logger.info("Converting column %s.%s to JSONB", table.name, column.name)
+                    engine.execute('ALTER TABLE {0} ALTER COLUMN {1} TYPE JSONB USING {1}::jsonb'.format(
+                        table.name, column.name))
+
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for name in OBSOLETE_INDEXES.get(table.name, ()):
+            if name in indexes:
+                current_app.logger.info("Dropping obsolete index %s", name)
+                engine.execute('DROP INDEX {}'.format(name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                current_app.logger.info("Creating index %s", index.name)
+                index.create(engine)
@@ -0,0 +1,55 @@
+import threading
+
+
+class TaskNotifier(object):
+    """
+    In-process notifications about new tasks, used to wake up long polling agents.
+
+    Every (task type, version, location key) triple has a sequence number that is incremented when tasks of that
+    type targeting that location are added. A waiter takes a snapshot of the sequence numbers of its capabilities and
+    location keys before looking for tasks and then waits for any of them to change, so tasks added between looking
+    for tasks and starting to wait are never missed. Tasks targeting a radius wake up all agents with coordinates.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequences = {}
+
+    def snapshot(self, capabilities, location_keys):
+        """
+        Take a snapshot of the current sequence numbers of given capabilities in given locations
+
+        :param capabilities: An iterable of (type, version) pairs
+        :param location_keys: Location keys of the tasks to wait for
+        :return: Snapshot to pass to wait()
+        """
+        with self._condition:
+            return {(task_type, task_version, location): self._sequences.get((task_type, task_version, location), 0)
+                    for task_type, task_version in capabilities for location in location_keys}
+
+    def notify(self, task_type, task_version, location):
+        """
+        Wake up everyone waiting for tasks of given type and version in given location
+
+        :param task_type: Type of the added task
+        :param task_version: Version of the added task
+        :param location: Location key of the added task
+        """
+        with self._condition:
+            key = (task_type, task_version, location)
+            self._sequences[key] = self._sequences.get(key, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, snapshot, timeout):
+        """
+        Wait until tasks matching any of the capabilities in the snapshot have been added
+
+        :param snapshot: Snapshot taken with snapshot()
+        :param timeout: Maximum time to wait in seconds
+        :return: True if matching tasks were added, False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._changed(snapshot), timeout)
+
+    def _changed(self, snapshot):
+        return any(self._sequences.get(key, 0) != sequence for key, sequence in snapshot.items())
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+import random
+
+from slamon_afm.cache import TimedCache
+from slamon_afm.models import db, Agent
+
+
+class PollScheduler(object):
+    """
+    Chooses when agents should poll next.
+
+    Agents with pending tasks matching their capabilities are told to return after busy_interval seconds, other
+    agents after idle_interval seconds. Each interval is spread randomly by up to jitter times its length either way,
+    so that agents started at the same time drift apart instead of polling in waves. With max_poll_rate set, the
+    intervals are stretched so that on average the whole fleet polls at most max_poll_rate times per second. The size
+    of the fleet is counted from the last seen times of the agents every FLEET_SIZE_REFRESH seconds.
+    """
+
+    FLEET_SIZE_REFRESH = 10
+
+    def __init__(self, idle_interval, busy_interval, jitter, max_poll_rate, heartbeat_interval):
+        self.idle_interval = idle_interval
+        self.busy_interval = busy_interval
+        self.jitter = jitter
+        self.max_poll_rate = max_poll_rate
+        self.heartbeat_interval = heartbeat_interval
+        self._fleet_size = TimedCache(self.FLEET_SIZE_REFRESH)
+        self._min_interval = 0
+
+    def interval(self, busy):
+        """
+        Time until the next poll of an agent
+
+        :param busy: True if there are pending tasks for the agent
+        :return: Interval in seconds
+        """
+        interval = self.busy_interval if busy else self.idle_interval
+        if self.max_poll_rate:
+            self._min_interval = self._fleet_size.get(self._count_fleet) / self.max_poll_rate
+            interval = max(interval, self._min_interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _count_fleet(self):
+        # every polling agent has been seen within its longest interval, heartbeats buffered by other processes may
+        # be up to heartbeat_interval seconds late
+        window = max(self.idle_interval, self._min_interval) * (1 + self.jitter) + self.heartbeat_interval
+        return db.session.query(Agent).filter(Agent.last_seen > datetime.utcnow() - timedelta(seconds=window)).count()
@@ -0,0 +1,83 @@
+from datetime import datetime
+import logging
+import time
+
+from flask import current_app
+from sqlalchemy import and_
+
+from slamon_afm.models import db, Task
+
+
+class TaskReaper(object):
+    """
+    Requeues claimed tasks whose lease has expired, and fails pending tasks whose TTL has expired.
+
+    Expired tasks are looked up by the indexed expiry times and updated in batches of batch_size tasks, each batch
+    in its own transaction to keep the locks short.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+    def sweep(self):
+        """
+        Reap all expired tasks
+
+        :return: A tuple of the number of requeued and failed tasks
+        """
+        started = time.monotonic()
+        now = datetime.utcnow()
+
+        requeued = self._reap(Task.lease_expires < now, {
+            Task.assigned_agent_uuid: None,
+            Task.claimed: None,
+            Task.lease_expires: None
+        })
+        expired = self._reap(and_(Task.expires < now, Task.assigned_agent_uuid.is_(None)), {
+            Task.failed: now,
+            Task.error: 'Task expired before it was claimed',
+            Task.expires: None
+        })
+
+        # requeued tasks are pending again, expired tasks are pending no more
+        pending_tasks = current_app.extensions['pending_tasks']
+        notifier = current_app.extensions['task_notifier']
+        for (task_type, task_version, location), count in requeued.items():
+            pending_tasks.add(task_type, task_version, count)
+            notifier.notify(task_type, task_version, location)
+        for (task_type, task_version, location), count in expired.items():
+            pending_tasks.remove(task_type, task_version, count)
+
+        num_requeued, num_expired = sum(requeued.values()), sum(expired.values())
+        current_app.logger.log(logging.INFO if num_requeued or num_expired else logging.DEBUG,
+                               "Reaper requeued %d tasks with expired leases and failed %d expired tasks in %.1f ms",
+                               num_requeued, num_expired, (time.monotonic() - started) * 1000)
+        return num_requeued, num_expired
+
+    def _reap(self, condition, values):
+        """
+        Update tasks matching the condition in batches
+
+        :return: A dict of number of updated tasks by (type, version, location)
+        """
+        updated = {}
+        while True:
+            batch = db.session.query(Task.uuid, Task.type, Task.version, Task.location).filter(condition). \
+                limit(self.batch_size).all()
+            if not batch:
+                break
+
+            # repeat the condition, the tasks may have been finished or claimed after the lookup
+            db.session.query(Task).filter(Task.uuid.in_([task.uuid for task in batch])).filter(condition). \
+                update(values, synchronize_session=False)
+            db.session.commit()
+
+            # count by the rows found, tasks changed in between are corrected by the next counter rebuild
+            for task in batch:
+                key = (task.type, task.version, task.location)
+                updated[key] = updated.get(key, 0) + 1
+
+            if len(batch) < self.batch_size:
+                break
+        return updated
+
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+import time
+
+from flask import current_app
+from sqlalchemy import literal, select
+
+from slamon_afm.models import db, Task, tasks_archive
+
+
+def purge_tasks(days, archive=True, batch_size=500):
+    """
+    Move finished tasks older than given number of days to the archive table, or delete them.
+
+    Tasks are moved in batches of batch_size tasks, each batch in its own transaction to keep the locks short.
+
+    :param days: Age of the finished tasks to purge, counted from the time the task finished
+    :param archive: Copy the tasks to the archive table before deleting them
+    :param batch_size: Maximum number of tasks purged in a single transaction
+    :return: Number of tasks purged
+    """
+    started = time.monotonic()
+    cutoff = datetime.utcnow() - timedelta(days=days)
+
+    # one indexed condition at a time
+    purged = _purge(Task.completed < cutoff, archive, batch_size) + _purge(Task.failed < cutoff, archive, batch_size)
+
+    if purged:
+        # purged tasks are no longer served
+        current_app.extensions['task_cache'].clear()
+
+    current_app.logger.info("%s %d tasks finished before %s in %.1f ms", 'Archived' if archive else 'Deleted',
+                            purged, cutoff, (time.monotonic() - started) * 1000)
+    return purged
+
+
+def _purge(condition, archive, batch_size):
+    columns = list(Task.__table__.columns)
+    purged = 0
+    while True:
+        task_uuids = [task_uuid for task_uuid, in db.session.query(Task.uuid).filter(condition).limit(batch_size)]
+        if not task_uuids:
+            break
+
+        if archive:
+            db.session.execute(tasks_archive.insert().from_select(
+                [column.name for column in columns] + ['archived'],
+                select(columns + [literal(datetime.utcnow(), tasks_archive.c.archived.type)]).
+                where(Task.__table__.c.uuid.in_(task_uuids))))
+        db.session.query(Task).filter(Task.uuid.in_(task_uuids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        purged += len(task_uuids)
+        if len(task_uuids) < batch_size:
+            break
+    return purged
+
+
+def purge_configured():
+    """
+    Purge finished tasks according to the retention configuration of the current application
+    """
+    return purge_tasks(current_app.config['TASK_RETENTION_DAYS'], current_app.config['TASK_RETENTION_ARCHIVE'],
+                       current_app.config['TASK_RETENTION_BATCH_SIZE'])
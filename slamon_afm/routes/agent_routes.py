@@ -1,14 +1,16 @@
 from datetime import datetime, timedelta
-import json
+import time
 
 import jsonschema
-from flask import request, abort, current_app
+from flask import abort, current_app
 from flask.blueprints import Blueprint
-from flask.json import jsonify
+from sqlalchemy import and_, bindparam
 from sqlalchemy.orm.exc import NoResultFound
 from dateutil import tz
 
+from slamon_afm.encoding import get_request_data, make_data_response
 from slamon_afm.models import db, Agent, Task
+from slamon_afm.validation import compile_schema
 
 blueprint = Blueprint('agent', __name__)
 
@@ -58,14 +60,25 @@ TASK_REQUEST_SCHEMA = {
                 }
             }
         },
+        'agent_capabilities_hash': {
+            'type': 'string',
+            'pattern': '^[a-f0-9]{40}$'
+        },
         'agent_time': {
             'type': 'string'
         },
         'max_tasks': {
             'type': 'integer'
+        },
+        'long_poll': {
+            'type': 'boolean'
         }
     },
-    'required': ['protocol', 'agent_id', 'agent_name', 'agent_time', 'agent_capabilities', 'max_tasks'],
+    'required': ['protocol', 'agent_id', 'agent_name', 'agent_time', 'max_tasks'],
+    'anyOf': [
+        {'required': ['agent_capabilities']},
+        {'required': ['agent_capabilities_hash']}
+    ],
     'additionalProperties': False
 }
 
@@ -78,6 +91,10 @@ TASK_RESPONSE_SCHEMA = {
                 'protocol': {
                     'type': 'integer'
                 },
+                'agent_id': {
+                    'type': 'string',
+                    'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
+                },
                 'task_id': {
                     'type': 'string',
                     'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
@@ -95,6 +112,10 @@ TASK_RESPONSE_SCHEMA = {
                 'protocol': {
                     'type': 'integer'
                 },
+                'agent_id': {
+                    'type': 'string',
+                    'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
+                },
                 'task_id': {
                     'type': 'string',
                     'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
@@ -109,17 +130,72 @@ TASK_RESPONSE_SCHEMA = {
     ]
 }
 
+TASK_RESPONSE_BATCH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'protocol': {
+            'type': 'integer'
+        },
+        'agent_id': {
+            'type': 'string',
+            'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
+        },
+        'responses': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'oneOf': [
+                    {
+                        'type': 'object',
+                        'properties': {
+                            'task_id': {
+                                'type': 'string',
+                                'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
+                            },
+                            'task_data': {
+                                'type': 'object'
+                            }
+                        },
+                        'additionalProperties': False,
+                        'required': ['task_id', 'task_data']
+                    },
+                    {
+                        'type': 'object',
+                        'properties': {
+                            'task_id': {
+                                'type': 'string',
+                                'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
+                            },
+                            'task_error': {
+                                'type': 'string'
+                            }
+                        },
+                        'additionalProperties': False,
+                        'required': ['task_id', 'task_error']
+                    }
+                ]
+            }
+        }
+    },
+    'additionalProperties': False,
+    'required': ['protocol', 'responses']
+}
+
+TASK_REQUEST_VALIDATOR = compile_schema(TASK_REQUEST_SCHEMA)
+TASK_RESPONSE_VALIDATOR = compile_schema(TASK_RESPONSE_SCHEMA)
+TASK_RESPONSE_BATCH_VALIDATOR = compile_schema(TASK_RESPONSE_BATCH_SCHEMA)
+
 
 @blueprint.route('/tasks', methods=['POST'], strict_slashes=False)
 def request_tasks():
-    data = request.json
+    data = get_request_data()
 
     if data is None:
         current_app.logger.error('No JSON data provided with request.')
         abort(400)
 
     try:
-        jsonschema.validate(data, TASK_REQUEST_SCHEMA)
+        TASK_REQUEST_VALIDATOR.validate(data)
     except jsonschema.ValidationError:
         current_app.logger.error('Invalid JSON data provided with request.')
         abort(400)
@@ -127,10 +203,10 @@ def request_tasks():
     protocol = int(data['protocol'])
     agent_uuid = str(data['agent_id'])
     agent_name = str(data['agent_name'])
-    agent_capabilities = data['agent_capabilities']
+    agent_capabilities = data.get('agent_capabilities')
     max_tasks = int(data['max_tasks'])
     # agent_time = data['agent_time']
-    # agent_location = data['agent_location'] if 'agent_location' in data else None
+    agent_location = data.get('agent_location')
 
     # Only protocol 1 supported for now
     if protocol != 1:
@@ -138,40 +214,91 @@ def request_tasks():
 
     # Update agent details in DB
     agent = Agent.get_agent(agent_uuid, agent_name)
-    agent.update_capabilities(agent_capabilities)
-    agent.last_seen = datetime.utcnow()
+    if agent_location is not None:
+        agent.update_location(agent_location)
+    capability_sets = current_app.extensions['capability_sets']
+    if agent_capabilities is not None:
+        agent.update_capabilities(agent_capabilities)
+        capabilities = [(name, int(info['version'])) for name, info in agent_capabilities.items()]
+        capabilities_hash = agent.capabilities_hash
+        capability_sets.put(capabilities_hash, capabilities, 1)
+    else:
+        # The agent sent only a fingerprint of its capabilities, which has to match the stored one
+        capabilities_hash = str(data['agent_capabilities_hash'])
+        if capabilities_hash != agent.capabilities_hash:
+            current_app.logger.info("Unknown capabilities fingerprint from agent %s, requesting full capabilities",
+                                    agent_uuid)
+            abort(409)
+        capabilities = capability_sets.get(capabilities_hash)
+        if capabilities is None:
+            capabilities = [(capability.type, capability.version) for capability in agent.capabilities]
+            capability_sets.put(capabilities_hash, capabilities, 1)
+    heartbeats = current_app.extensions['heartbeats']
+    heartbeats.record(agent.uuid, datetime.utcnow())
 
-    # Calculate return time for the agent (next polling time)
-    return_time = (datetime.now(tz.tzlocal()) + timedelta(0, current_app.config.get('AGENT_RETURN_TIME'))).isoformat()
+    # Claim tasks for agent, in long polling mode wait for matching tasks to be added until the timeout
+    notifier = current_app.extensions['task_notifier']
+    long_poll_timeout = current_app.config['AGENT_LONG_POLL_TIMEOUT'] if data.get('long_poll') else 0
+    deadline = time.monotonic() + long_poll_timeout
+
+    location_keys = agent.location_keys()
+    snapshot = notifier.snapshot(capabilities, location_keys)
+    tasks = _claim_tasks(agent, capabilities, max_tasks)
+    while not tasks and time.monotonic() < deadline:
+        # release database locks while waiting
+        db.session.commit()
+        notifier.wait(snapshot, deadline - time.monotonic())
+        snapshot = notifier.snapshot(capabilities, location_keys)
+        tasks = _claim_tasks(agent, capabilities, max_tasks)
+
+    # Calculate return time for the agent (next polling time), sooner if there are more tasks for the agent. Claiming
+    # stops short of max_tasks only when there are no more tasks the agent could claim.
+    busy = bool(tasks) and len(tasks) >= max_tasks and \
+        Task.has_candidates(agent, capabilities, [task['task_id'] for task in tasks])
+    return_time = (datetime.now(tz.tzlocal()) +
+                   timedelta(0, current_app.extensions['poll_scheduler'].interval(busy))).isoformat()
 
-    # Claim tasks for agent
-    tasks = [{'task_id': task.uuid, 'task_type': task.type, 'task_version': task.version,
-              'task_data': json.loads(task.data)} for task in Task.claim_tasks(agent, max_tasks)]
     if len(tasks) > 0:
-        current_app.logger.info("Assigning tasks {} to agent {}, {}"
-                                .format([task['task_id'] for task in tasks], agent_name, agent_uuid))
-        current_app.logger.debug("Task details: {}".format(tasks))
+        current_app.logger.info("Assigning tasks %s to agent %s, %s",
+                                [task['task_id'] for task in tasks], agent_name, agent_uuid)
+        if current_app.config['LOG_PAYLOADS']:
+            current_app.logger.debug("Task details: %s", tasks)
 
-    response = jsonify(tasks=tasks, return_time=return_time)
+    response = make_data_response({'tasks': tasks, 'return_time': return_time, 'capabilities_hash': capabilities_hash})
 
     # commit only after serializing the response
     db.session.commit()
 
+    pending_tasks = current_app.extensions['pending_tasks']
+    for task in tasks:
+        pending_tasks.remove(task['task_type'], task['task_version'])
+
+    heartbeats.flush_if_due()
+
     return response
 
 
+def _claim_tasks(agent, capabilities, max_tasks):
+    # skip the claim query when none of the capabilities have pending tasks
+    if not current_app.extensions['pending_tasks'].has_pending(capabilities):
+        return []
+
+    return [{'task_id': task.uuid, 'task_type': task.type, 'task_version': task.version,
+             'task_data': task.data_json} for task in Task.claim_tasks(agent, max_tasks, capabilities)]
+
+
 @blueprint.route('/tasks/response', methods=['POST'], strict_slashes=False)
 def post_tasks():
-    data = request.json
+    data = get_request_data()
 
     if data is None:
         current_app.logger.error("No JSON content in task response request!")
         abort(400)
 
     try:
-        jsonschema.validate(data, TASK_RESPONSE_SCHEMA)
+        TASK_RESPONSE_VALIDATOR.validate(data)
     except jsonschema.ValidationError as e:
-        current_app.logger.error("Invalid JSON in task reponse: {0}".format(e))
+        current_app.logger.error("Invalid JSON in task reponse: %s", e)
         abort(400)
 
     protocol = int(data['protocol'])
@@ -179,7 +306,7 @@ def post_tasks():
 
     # Only protocol 1 supported for now
     if protocol != 1:
-        current_app.logger.error("Invalid protocol in task response: {0}".format(protocol))
+        current_app.logger.error("Invalid protocol in task response: %s", protocol)
         abort(400)
 
     try:
@@ -189,15 +316,22 @@ def post_tasks():
             current_app.logger.error("Incomplete task posted!")
             abort(400)
 
-        result = ""
+        if 'agent_id' in data and task.assigned_agent_uuid != str(data['agent_id']):
+            # the lease of the agent has expired and the task has been claimed by another agent
+            current_app.logger.error("Task %s posted by agent %s, but it is assigned to agent %s", task_id,
+                                     data['agent_id'], task.assigned_agent_uuid)
+            abort(400)
+
         if 'task_data' in data:
-            task.result_data = json.dumps(data['task_data'])
+            task.result_data = data['task_data']
             task.completed = datetime.utcnow()
-            result = json.dumps(task.result_data)
+            result = task.result_data
         elif 'task_error' in data:
             task.error = data['task_error']
             task.failed = datetime.utcnow()
             result = task.error
+        task.lease_expires = None
+        task.expires = None
 
         db.session.add(task)
     except NoResultFound:
@@ -211,7 +345,121 @@ def post_tasks():
         current_app.logger.error("Failed to commit database changes for task result POST")
         abort(500)
 
-    current_app.logger.info("An agent returned task with results - uuid: {}".format(task_id))
-    current_app.logger.debug("Task results: {}".format(result))
+    current_app.logger.info("An agent returned task with results - uuid: %s", task_id)
+    if current_app.config['LOG_PAYLOADS']:
+        current_app.logger.debug("Task results: %s", result)
 
     return ('', 200)
+
+
+@blueprint.route('/tasks/response/batch', methods=['POST'], strict_slashes=False)
+def post_tasks_batch():
+    """
+    Post results of multiple tasks at once, all results are stored in a single transaction
+    :return: dict in following format, results in the same order as the posted responses
+    {
+        'results': [
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',  # UUID of the task (str)
+                'status': 'ok'                                      # 'ok', 'unknown' or 'invalid'
+            }
+        ]
+    }
+    """
+    data = get_request_data()
+
+    if data is None:
+        current_app.logger.error("No JSON content in task response batch request!")
+        abort(400)
+
+    try:
+        TASK_RESPONSE_BATCH_VALIDATOR.validate(data)
+    except jsonschema.ValidationError as e:
+        current_app.logger.error("Invalid JSON in task response batch: %s", e)
+        abort(400)
+
+    protocol = int(data['protocol'])
+
+    # Only protocol 1 supported for now
+    if protocol != 1:
+        current_app.logger.error("Invalid protocol in task response batch: %s", protocol)
+        abort(400)
+
+    responses = data['responses']
+    agent_uuid = str(data['agent_id']) if 'agent_id' in data else None
+
+    # look up states of all the tasks, in chunks to stay within bound parameter limits
+    task_uuids = list({str(response['task_id']) for response in responses})
+    states = {}
+    for i in range(0, len(task_uuids), 500):
+        for task_uuid, assigned_agent_uuid, claimed, completed, failed in \
+                db.session.query(Task.uuid, Task.assigned_agent_uuid, Task.claimed, Task.completed, Task.failed). \
+                filter(Task.uuid.in_(task_uuids[i:i + 500])):
+            states[task_uuid] = 'open' if claimed is not None and completed is None and failed is None and \
+                agent_uuid in (None, assigned_agent_uuid) else 'invalid'
+
+    results = []
+    completions = []
+    failures = []
+    for response in responses:
+        task_uuid = str(response['task_id'])
+        status = states.get(task_uuid, 'unknown')
+        if status == 'open':
+            # only the first response for each task is accepted
+            states[task_uuid] = 'invalid'
+            status = 'ok'
+            if 'task_data' in response:
+                completions.append({'b_uuid': task_uuid, 'b_result_data': response['task_data']})
+            else:
+                failures.append({'b_uuid': task_uuid, 'b_error': response['task_error']})
+        results.append({'task_id': task_uuid, 'status': status})
+
+    # the time of failure is stored in the 'started' column
+    now = datetime.utcnow()
+    unfinished = and_(Task.__table__.c.uuid == bindparam('b_uuid'), Task.__table__.c.claimed.isnot(None),
+                      Task.__table__.c.completed.is_(None), Task.__table__.c.started.is_(None))
+    if agent_uuid is not None:
+        unfinished = and_(unfinished, Task.__table__.c.assigned_agent_uuid == agent_uuid)
+    try:
+        updated = 0
+        if completions:
+            updated += db.session.execute(Task.__table__.update().where(unfinished).values(
+                result_data=bindparam('b_result_data'), completed=now, lease_expires=None, expires=None),
+                completions).rowcount
+        if failures:
+            updated += db.session.execute(Task.__table__.update().where(unfinished).values(
+                error=bindparam('b_error'), started=now, lease_expires=None, expires=None), failures).rowcount
+
+        if updated != len(completions) + len(failures) or not db.engine.dialect.supports_sane_multi_rowcount:
+            # some of the tasks were finished concurrently, the tasks finished by this request have the same finish
+            # time and the expected agent
+            _reject_unaccepted(results, now, agent_uuid)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        current_app.logger.error("Failed to commit database changes for task result batch POST")
+        abort(500)
+
+    current_app.logger.info("An agent returned results for tasks %s",
+                            [result['task_id'] for result in results if result['status'] == 'ok'])
+
+    return make_data_response({'results': results})
+
+
+def _reject_unaccepted(results, finished, agent_uuid):
+    """
+    Mark the accepted results of a batch invalid unless the task was finished by the batch, i.e. at the finish time
+    set by the batch and by the agent that posted it.
+    """
+    task_uuids = [result['task_id'] for result in results if result['status'] == 'ok']
+    accepted = set()
+    for i in range(0, len(task_uuids), 500):
+        query = db.session.query(Task.uuid).filter(Task.uuid.in_(task_uuids[i:i + 500])). \
+            filter((Task.completed == finished) | (Task.failed == finished))
+        if agent_uuid is not None:
+            query = query.filter(Task.assigned_agent_uuid == agent_uuid)
+        accepted.update(task_uuid for task_uuid, in query)
+    for result in results:
+        if result['status'] == 'ok' and result['task_id'] not in accepted:
+            result['status'] = 'invalid'
@@ -1,12 +1,18 @@
-import json
+from datetime import datetime, timedelta
+import hashlib
+import time
+import uuid
 
 import jsonschema
+from sqlalchemy.orm import undefer
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 from flask.blueprints import Blueprint
-from flask import request, abort, jsonify, current_app
+from flask import request, abort, current_app
 
+from slamon_afm.encoding import get_request_data, make_data_response, response_mimetype
 from slamon_afm.models import db, Task
+from slamon_afm.validation import compile_schema
 
 blueprint = Blueprint('bpms', __name__)
 
@@ -26,6 +32,55 @@ POST_TASK_SCHEMA = {
         'task_data': {
             'type': 'object'
         },
+        'task_ttl': {
+            'type': 'integer',
+            'minimum': 1
+        },
+        'task_priority': {
+            'type': 'integer'
+        },
+        'task_location': {
+            'type': 'object',
+            'oneOf': [
+                {
+                    'properties': {
+                        'country': {
+                            'type': 'string',
+                            'minLength': 2,
+                            'maxLength': 2
+                        },
+                        'region': {
+                            'type': 'string',
+                            'minLength': 2,
+                            'maxLength': 4
+                        }
+                    },
+                    'required': ['country'],
+                    'additionalProperties': False
+                },
+                {
+                    'properties': {
+                        'latitude': {
+                            'type': 'number',
+                            'minimum': -90,
+                            'maximum': 90
+                        },
+                        'longitude': {
+                            'type': 'number',
+                            'minimum': -180,
+                            'maximum': 180
+                        },
+                        'radius': {
+                            'type': 'number',
+                            'minimum': 0,
+                            'exclusiveMinimum': True
+                        }
+                    },
+                    'required': ['latitude', 'longitude', 'radius'],
+                    'additionalProperties': False
+                }
+            ]
+        },
         'test_id': {
             'type': 'string',
             'pattern': '^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12}$'
@@ -35,16 +90,18 @@ POST_TASK_SCHEMA = {
     'additionalProperties': False
 }
 
+POST_TASK_VALIDATOR = compile_schema(POST_TASK_SCHEMA)
+
 
 @blueprint.route('/task', methods=['POST'], strict_slashes=False)
 def post_task():
-    data = request.json
+    data = get_request_data()
 
     if data is None:
         abort(400)
 
     try:
-        jsonschema.validate(data, POST_TASK_SCHEMA)
+        POST_TASK_VALIDATOR.validate(data)
     except jsonschema.ValidationError:
         abort(400)
 
@@ -57,11 +114,14 @@ def post_task():
         uuid=task_uuid,
         type=task_type,
         version=int(data['task_version']),
-        test_id=task_test_id
+        test_id=task_test_id,
+        priority=int(data.get('task_priority', 0)),
+        expires=_expires(data),
+        **_location(data)
     )
 
     if 'task_data' in data:
-        task_data = json.dumps(data['task_data'])
+        task_data = data['task_data']
         task.data = task_data
 
     try:
@@ -77,12 +137,144 @@ def post_task():
         current_app.logger.error("Failed to commit database changes for BPMS task POST")
         abort(400)
 
-    current_app.logger.info("Task posted by BPMS - Task's type: {}, test process id: {}, uuid: {}, parameters: {}"
-                            .format(task_type, task_test_id, task_uuid, task_data))
+    _tasks_added({(task_type, int(data['task_version']), task.location): 1})
+
+    current_app.logger.info("Task posted by BPMS - Task's type: %s, test process id: %s, uuid: %s",
+                            task_type, task_test_id, task_uuid)
+    if current_app.config['LOG_PAYLOADS']:
+        current_app.logger.debug("Task parameters: %s", task_data)
 
     return ('', 200)
 
 
+@blueprint.route('/task/batch', methods=['POST'], strict_slashes=False)
+def post_task_batch():
+    """
+    Post multiple tasks at once, all valid tasks are inserted in a single transaction unless some of them were
+    inserted concurrently
+    :return: dict in following format, results in the same order as the posted tasks
+    {
+        'results': [
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',  # UUID of the task (str), None if missing
+                'status': 'ok',                                     # 'ok', 'invalid' or 'duplicate'
+                'error': 'Task with the same id already exists'     # Reason for failure (if failed)
+            }
+        ]
+    }
+    """
+    data = get_request_data()
+
+    if not isinstance(data, list) or len(data) > current_app.config['TASK_BATCH_MAX_SIZE']:
+        abort(400)
+
+    results = []
+    tasks = {}
+    for item in data:
+        result = {'task_id': item.get('task_id') if isinstance(item, dict) else None, 'status': 'ok'}
+        results.append(result)
+        try:
+            POST_TASK_VALIDATOR.validate(item)
+        except jsonschema.ValidationError as e:
+            result.update(status='invalid', error=e.message)
+            continue
+        if item['task_id'] in tasks:
+            result.update(status='duplicate', error='Task with the same id posted earlier in the batch')
+            continue
+        tasks[item['task_id']] = {
+            'uuid': str(item['task_id']),
+            'test_id': str(item['test_id']),
+            'type': str(item['task_type']),
+            'version': int(item['task_version']),
+            'data': item.get('task_data'),
+            'priority': int(item.get('task_priority', 0)),
+            'expires': _expires(item)
+        }
+        tasks[item['task_id']].update(_location(item))
+
+    # filter out tasks that already exist, in chunks to stay within bound parameter limits
+    task_uuids = list(tasks)
+    for i in range(0, len(task_uuids), 500):
+        for task_uuid, in db.session.query(Task.uuid).filter(Task.uuid.in_(task_uuids[i:i + 500])):
+            del tasks[task_uuid]
+    for result in results:
+        if result['status'] == 'ok' and result['task_id'] not in tasks:
+            result.update(status='duplicate', error='Task with the same id already exists')
+
+    if tasks:
+        try:
+            db.session.execute(Task.__table__.insert(), list(tasks.values()))
+            db.session.commit()
+        except IntegrityError:
+            # a task was inserted concurrently, insert the tasks one at a time to find out which ones
+            db.session.rollback()
+            _insert_tasks_one_by_one(tasks, results)
+        except ProgrammingError:
+            db.session.rollback()
+            current_app.logger.error("Failed to commit database changes for BPMS task batch POST")
+            abort(400)
+
+    added = {}
+    for task in tasks.values():
+        key = (task['type'], task['version'], task['location'])
+        added[key] = added.get(key, 0) + 1
+    _tasks_added(added)
+
+    current_app.logger.info("Task batch posted by BPMS - %d tasks posted, %d added", len(data), len(tasks))
+
+    return make_data_response({'results': results})
+
+
+def _insert_tasks_one_by_one(tasks, results):
+    """
+    Insert the tasks of a batch each in a transaction of its own, marking and removing the duplicates
+    """
+    for task_uuid, task in list(tasks.items()):
+        try:
+            db.session.execute(Task.__table__.insert(), task)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            del tasks[task_uuid]
+            for result in results:
+                if result['status'] == 'ok' and result['task_id'] == task_uuid:
+                    result.update(status='duplicate', error='Task with the same id already exists')
+
+
+def _expires(data):
+    """
+    Expiry time of a posted task, None if the task has no TTL
+    """
+    return datetime.utcnow() + timedelta(seconds=data['task_ttl']) if 'task_ttl' in data else None
+
+
+def _location(data):
+    """
+    Location columns of a posted task, tasks without task_location may be run anywhere
+    """
+    location = data.get('task_location')
+    if location is None:
+        return {'location': Task.ANYWHERE, 'target_latitude': None, 'target_longitude': None, 'target_radius': None}
+    if 'radius' in location:
+        return {'location': Task.WITHIN_RADIUS, 'target_latitude': float(location['latitude']),
+                'target_longitude': float(location['longitude']), 'target_radius': float(location['radius'])}
+    return {'location': Task.location_key(location['country'], location.get('region')), 'target_latitude': None,
+            'target_longitude': None, 'target_radius': None}
+
+
+def _tasks_added(added):
+    """
+    Count in new tasks and wake up agents waiting for them
+
+    :param added: A dict of number of tasks added by (type, version, location)
+    """
+    pending_tasks = current_app.extensions['pending_tasks']
+    notifier = current_app.extensions['task_notifier']
+    for (task_type, task_version, location), count in added.items():
+        pending_tasks.add(task_type, task_version, count)
+        notifier.notify(task_type, task_version, location)
+
+
 @blueprint.route('/task/<uuid:task_uuid>', methods=['GET'], strict_slashes=False)
 def get_task(task_uuid):
     """
@@ -95,19 +287,113 @@ def get_task(task_uuid):
         'task_type': 'wait',                                # type of the task (str)
         'task_version': 1,                                  # Version number of the task
         'task_data': {},                                    # Dict containing data passed to the task (if any)
+        'task_location': {'country': 'FI'},                 # Location the task targets (if any)
         'task_completed': '31-03-2015:12:12:12',            # Time when task was completed (if completed)
         'task_result': {},                                  # Dict containing task's results (if completed)
         'task_failed': '31-03-2015:12:12:12',               # Time when task failed (if failed)
         'task_error': 'Something went wrong'                # Error that caused task to fail (if failed)
     }
+
+    Completed and failed tasks never change, their responses are cached in memory and may be cached by clients for
+    up to TASK_CACHE_MAX_AGE seconds, but no longer than until the task is due to be purged by the retention policy.
+    Responses are tagged with an ETag derived from their content, so conditional requests for an unchanged task are
+    answered with 304.
+    """
+    mimetype = response_mimetype()
+    task_cache = current_app.extensions['task_cache']
+    cached = task_cache.get((str(task_uuid), mimetype))
+    if cached is not None and _cache_lifetime(*cached[2:]) <= 0:
+        # the task may have been purged since, possibly by another AFM process
+        cached = None
+
+    if cached is None:
+        try:
+            query = db.session.query(Task).options(undefer(Task.data), undefer(Task.result_data))
+            task = query.filter(Task.uuid == str(task_uuid)).one()
+        except NoResultFound:
+            abort(404)
+
+        body = make_data_response(describe_task(task), mimetype).get_data()
+        cached = (body, hashlib.sha1(body).hexdigest(), task.completed or task.failed, time.monotonic())
+        if cached[2] is not None and _cache_lifetime(*cached[2:]) > 0:
+            task_cache.put((str(task_uuid), mimetype), cached, len(body))
+
+    body, etag, finished, cached_at = cached
+    response = current_app.response_class(body, mimetype=mimetype)
+    response.vary.add('Accept')
+    if finished is not None:
+        response.cache_control.max_age = max(0, int(_cache_lifetime(finished, cached_at)))
+    else:
+        response.cache_control.no_cache = True
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def _cache_lifetime(finished, cached_at):
+    """
+    Remaining time a finished task response may be served from caches
+
+    :param finished: Time the task finished
+    :param cached_at: Monotonic time the response was generated
+    :return: Lifetime in seconds, zero or negative if expired
+    """
+    lifetime = current_app.config['TASK_CACHE_MAX_AGE'] - (time.monotonic() - cached_at)
+    retention_days = current_app.config['TASK_RETENTION_DAYS']
+    if retention_days:
+        lifetime = min(lifetime, (finished + timedelta(days=retention_days) - datetime.utcnow()).total_seconds())
+    return lifetime
+
+
+@blueprint.route('/task', methods=['GET'], strict_slashes=False)
+def get_tasks():
     """
+    Gets information about multiple tasks, selected by task ids, a test id or both. Tasks are returned in the order
+    of their ids, one page at a time.
+
+    Query parameters:
+        task_id: UUID of a task to include, may be repeated
+        test_id: UUID of the test whose tasks to include
+        after: Return only tasks whose ids follow this UUID, the 'next' value of the previous page
+        limit: Maximum number of tasks to return, defaults to 100
 
+    :return: dict in following format
+    {
+        'tasks': [...],                                     # Tasks in the same format as returned by get_task
+        'next': 'de305d54-75b4-431b-adb2-eb6b9e546013'      # Value of 'after' for the next page, None if last page
+    }
+    """
     try:
-        query = db.session.query(Task)
-        task = query.filter(Task.uuid == str(task_uuid)).one()
-    except NoResultFound:
-        abort(404)
+        task_uuids = [str(uuid.UUID(value)) for value in request.args.getlist('task_id')]
+        test_id = str(uuid.UUID(request.args['test_id'])) if 'test_id' in request.args else None
+        after = str(uuid.UUID(request.args['after'])) if 'after' in request.args else None
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        abort(400)
+
+    if not (task_uuids or test_id) or not 0 < limit <= current_app.config['TASK_QUERY_MAX_LIMIT'] or \
+            len(task_uuids) > current_app.config['TASK_QUERY_MAX_LIMIT']:
+        abort(400)
+
+    query = db.session.query(Task).options(undefer(Task.data), undefer(Task.result_data))
+    if task_uuids:
+        query = query.filter(Task.uuid.in_(task_uuids))
+    if test_id:
+        query = query.filter(Task.test_id == test_id)
+    if after:
+        query = query.filter(Task.uuid > after)
+    tasks = query.order_by(Task.uuid).limit(limit).all()
+
+    return make_data_response({'tasks': [describe_task(task) for task in tasks],
+                               'next': tasks[-1].uuid if len(tasks) == limit else None})
+
 
+def describe_task(task):
+    """
+    Describe the state of a task in the format returned by the BPMS API
+
+    :param task: The task
+    :return: Task description as a dict
+    """
     task_desc = {
         'task_id': task.uuid,
         'test_id': task.test_id,
@@ -116,13 +402,19 @@ def get_task(task_uuid):
     }
 
     if task.data is not None:
-        task_desc['task_data'] = json.loads(task.data)
+        task_desc['task_data'] = task.data
+
+    if task.location == Task.WITHIN_RADIUS:
+        task_desc['task_location'] = {'latitude': task.target_latitude, 'longitude': task.target_longitude,
+                                      'radius': task.target_radius}
+    elif task.location:
+        task_desc['task_location'] = dict(zip(('country', 'region'), task.location.split('-', 1)))
 
     if task.failed:
         task_desc['task_failed'] = str(task.failed)
         task_desc['task_error'] = str(task.error)
     elif task.completed:
         task_desc['task_completed'] = str(task.completed)
-        task_desc['task_result'] = json.loads(task.result_data)
+        task_desc['task_result'] = task.result_data
 
-    return jsonify(task_desc)
+    return task_desc
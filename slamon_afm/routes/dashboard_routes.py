@@ -1,6 +1,9 @@
+import hashlib
 import os.path
-from flask import jsonify, send_file
+from flask import Response, abort, current_app, request, send_file, stream_with_context, url_for
 from flask.blueprints import Blueprint
+from flask.json import dumps
+from sqlalchemy import func
 
 from slamon_afm.models import db, Agent, Task
 
@@ -15,26 +18,125 @@ def serialize_task(task):
         'test_id': task.test_id,
         'task_failed': str(task.failed) if task.failed else None,
         'task_completed': str(task.completed) if task.completed else None,
-        'task_result': task.result_data,
         'task_error': task.error
     }
 
 
-def serialize_agent(agent):
+def serialize_agent(agent, tasks):
     return {
         'agent_id': agent.uuid,
         'agent_name': agent.name,
         'last_seen': str(agent.last_seen),
-        'tasks': [serialize_task(task) for task in agent.tasks]
+        'tasks': [serialize_task(task) for task in tasks]
     }
 
 
+# Task columns shown on the dashboard, task results are fetched from the BPMS API when needed
+TASK_COLUMNS = (Task.uuid, Task.type, Task.version, Task.test_id, Task.failed.label('failed'), Task.completed,
+                Task.error)
+
+
 @blueprint.route('/dashboard/status', strict_slashes=False)
 def dev_get_agents():
-    return jsonify(
-        tasks=[serialize_task(task) for task in db.session.query(Task).filter(Task.assigned_agent_uuid == None)],
-        agents=[serialize_agent(agent) for agent in db.session.query(Agent).all()]
-    )
+    """
+    Dashboard snapshot of pending tasks and agents with their latest tasks, one page of agents at a time. If there
+    are more agents, the response has a Link header pointing to the next page.
+
+    Snapshots are cached for DASHBOARD_CACHE_TTL seconds and tagged with an ETag derived from their content, so
+    conditional requests for an unchanged snapshot are answered with 304. With caching disabled the response is
+    streamed while it is generated.
+
+    Query parameters:
+        after: Return only agents whose ids follow this UUID
+        limit: Maximum number of agents (and pending tasks) to return, defaults to DASHBOARD_PAGE_SIZE
+        tasks: Maximum number of tasks to return per agent, defaults to DASHBOARD_TASKS_PER_AGENT
+    """
+    try:
+        after = request.args.get('after')
+        limit = int(request.args.get('limit', current_app.config['DASHBOARD_PAGE_SIZE']))
+        tasks_per_agent = int(request.args.get('tasks', current_app.config['DASHBOARD_TASKS_PER_AGENT']))
+    except ValueError:
+        abort(400)
+
+    if not 0 < limit <= current_app.config['DASHBOARD_PAGE_SIZE'] or \
+            not 0 <= tasks_per_agent <= current_app.config['DASHBOARD_TASKS_PER_AGENT']:
+        abort(400)
+
+    if not current_app.config['DASHBOARD_CACHE_TTL']:
+        body, headers = _snapshot(after, limit, tasks_per_agent)
+        return Response(stream_with_context(body), mimetype='application/json', headers=headers)
+
+    def compute():
+        body, headers = _snapshot(after, limit, tasks_per_agent)
+        body = ''.join(body).encode('utf-8')
+        return body, headers, hashlib.sha1(body).hexdigest()
+
+    body, headers, etag = current_app.extensions['dashboard_cache'].get(compute, key=(after, limit, tasks_per_agent))
+
+    response = Response(body, mimetype='application/json', headers=headers)
+    response.cache_control.no_cache = True
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def _snapshot(after, limit, tasks_per_agent):
+    """
+    Query a dashboard snapshot
+
+    :return: A tuple of a generator yielding the JSON document in chunks, and a dict of response headers
+    """
+    current_app.extensions['heartbeats'].flush()
+
+    query = db.session.query(Agent.uuid, Agent.name, Agent.last_seen)
+    if after:
+        query = query.filter(Agent.uuid > after)
+    agents = query.order_by(Agent.uuid).limit(limit).all()
+
+    headers = {}
+    if len(agents) == limit:
+        headers['Link'] = '<{}>; rel="next"'.format(url_for('.dev_get_agents', after=agents[-1].uuid, limit=limit,
+                                                            tasks=tasks_per_agent))
+
+    def generate():
+        # pending tasks only on the first page
+        yield '{"tasks": ['
+        if not after:
+            pending = db.session.query(*TASK_COLUMNS).filter(Task.PENDING). \
+                order_by(Task.created).limit(limit)
+            for i, task in enumerate(pending):
+                yield (', ' if i else '') + dumps(serialize_task(task))
+
+        yield '], "agents": ['
+        tasks = _latest_tasks([agent.uuid for agent in agents], tasks_per_agent)
+        for i, agent in enumerate(agents):
+            yield (', ' if i else '') + dumps(serialize_agent(agent, tasks.get(agent.uuid, [])))
+        yield ']}'
+
+    return generate(), headers
+
+
+def _latest_tasks(agent_uuids, tasks_per_agent):
+    """
+    Query latest claimed tasks of agents in one query
+
+    :param agent_uuids: UUIDs of the agents
+    :param tasks_per_agent: Maximum number of tasks per agent
+    :return: A dict of task lists by agent uuid
+    """
+    if not agent_uuids or not tasks_per_agent:
+        return {}
+
+    row_number = func.row_number().over(partition_by=Task.assigned_agent_uuid,
+                                        order_by=Task.claimed.desc()).label('row_number')
+    ranked = db.session.query(Task.assigned_agent_uuid, row_number, *TASK_COLUMNS). \
+        filter(Task.assigned_agent_uuid.in_(agent_uuids)).subquery()
+    query = db.session.query(ranked).filter(ranked.c.row_number <= tasks_per_agent). \
+        order_by(ranked.c.assigned_agent_uuid, ranked.c.row_number)
+
+    tasks = {}
+    for task in query:
+        tasks.setdefault(task.assigned_agent_uuid, []).append(task)
+    return tasks
 
 
 @blueprint.route('/dashboard', strict_slashes=False)
@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 from flask.blueprints import Blueprint
 from flask import abort, current_app
 from flask.json import jsonify
+from sqlalchemy import and_, case, func
 
 from slamon_afm.models import db, Agent, Task
 
@@ -12,20 +13,71 @@ blueprint = Blueprint('status', __name__)
 @blueprint.route('/status', methods=['GET'], strict_slashes=False)
 def status():
     """
-    Simple status page which verifies that database connectivity works and tells stats about pending tasks and active
-    agents
+    Simple status page which verifies that database connectivity works and tells stats about tasks and active
+    agents. The stats are cached for STATUS_CACHE_TTL seconds.
     :return: dict in following format
     {
         'agents': 5,        # Number of agents that have been active within last Settings.agent_active_threshold seconds
         'tasks_waiting': 10 # Number of tasks that haven't been claimed yet
+        'tasks': {          # Number of tasks in each state
+            'pending': 10,
+            'claimed': 2,
+            'completed': 100,
+            'failed': 1
+        },
+        'task_cache': {     # Statistics of the finished task response cache of the AFM process
+            'entries': 100,
+            'bytes': 102400,
+            'hits': 900,
+            'misses': 100,
+            'evictions': 0,
+            'hit_rate': 0.9
+        },
+        'task_types': [     # Number of tasks in each state by task type and version
+            {
+                'task_type': 'wait',
+                'task_version': 1,
+                'pending': 10,
+                'claimed': 2,
+                'completed': 100,
+                'failed': 1
+            }
+        ]
     }
     """
 
-    agent_time_threshold = datetime.utcnow() - timedelta(0, current_app.config['AGENT_ACTIVE_THRESHOLD'])
-
     try:
-        num_agents = db.session.query(Agent).filter(Agent.last_seen > agent_time_threshold).count()
-        tasks_waiting = db.session.query(Task).filter(Task.claimed is None).count()
-        return jsonify(agents=num_agents, tasks_waiting=tasks_waiting)
+        return jsonify(dict(current_app.extensions['status_cache'].get(_collect_status),
+                            task_cache=current_app.extensions['task_cache'].stats()))
     except Exception as e:
         abort(500, 'Failed to query tasks and agents ' + str(e))
+
+
+def _collect_status():
+    # write the heartbeats buffered by this process, those buffered by other processes may be up to
+    # AGENT_HEARTBEAT_INTERVAL seconds late
+    current_app.extensions['heartbeats'].flush()
+    agent_time_threshold = datetime.utcnow() - timedelta(0, current_app.config['AGENT_ACTIVE_THRESHOLD'])
+    num_agents = db.session.query(Agent).filter(Agent.last_seen > agent_time_threshold).count()
+
+    unfinished = and_(Task.completed.is_(None), Task.failed.is_(None))
+    query = db.session.query(
+        Task.type, Task.version,
+        func.sum(case([(Task.PENDING, 1)], else_=0)),
+        func.sum(case([(and_(unfinished, Task.assigned_agent_uuid.isnot(None)), 1)], else_=0)),
+        func.count(Task.completed),
+        func.count(Task.failed)
+    ).group_by(Task.type, Task.version).order_by(Task.type, Task.version)
+
+    totals = {'pending': 0, 'claimed': 0, 'completed': 0, 'failed': 0}
+    task_types = []
+    for task_type, task_version, pending, claimed, completed, failed in query:
+        counts = {'pending': int(pending), 'claimed': int(claimed), 'completed': int(completed), 'failed': int(failed)}
+        for state, count in counts.items():
+            totals[state] += count
+        task_types.append(dict(counts, task_type=task_type, task_version=task_version))
+
+    # end the read only transaction
+    db.session.commit()
+
+    return {'agents': num_agents, 'tasks_waiting': totals['pending'], 'tasks': totals, 'task_types': task_types}
@@ -0,0 +1,29 @@
+from gunicorn.app.base import BaseApplication
+
+from slamon_afm.app import create_app
+
+
+class AFMServer(BaseApplication):
+    """
+    Gunicorn application serving AFM from multiple worker processes.
+
+    Every worker process creates its own AFM application instance after forking from the master process, so
+    database engines and connection pools are never shared between processes. The master process reloads the
+    workers gracefully on SIGHUP and shuts down gracefully on SIGTERM.
+    """
+
+    def __init__(self, config, options):
+        """
+        :param config: AFM configuration for the worker applications
+        :param options: Gunicorn settings
+        """
+        self.afm_config = config
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_app(config=self.afm_config)
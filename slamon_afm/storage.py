@@ -0,0 +1,102 @@
+import json
+import zlib
+
+from flask import current_app
+from sqlalchemy import LargeBinary
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator
+
+from slamon_afm.encoding import RawJSON, json_dumps
+
+# Marker prefixed to compressed documents, JSON text never starts with it
+COMPRESSED = b'\x01'
+
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+
+class JSONDocument(TypeDecorator):
+    """
+    Column type for JSON documents, the values are the decoded documents.
+
+    Documents are stored as native JSONB on PostgreSQL. On other backends they are stored as compact JSON text, and
+    documents larger than TASK_DATA_COMPRESS_THRESHOLD bytes are compressed with zlib. Documents stored as plain
+    JSON text by earlier versions are read as well.
+    """
+
+    impl = LargeBinary
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(JSONB(none_as_null=True))
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+
+        encoded = json_dumps(value).encode('utf-8')
+        threshold = current_app.config['TASK_DATA_COMPRESS_THRESHOLD'] if current_app else DEFAULT_COMPRESS_THRESHOLD
+        if threshold and len(encoded) > threshold:
+            return COMPRESSED + zlib.compress(encoded)
+        return encoded
+
+    def result_processor(self, dialect, coltype):
+        if dialect.name == 'postgresql':
+            return super().result_processor(dialect, coltype)
+        # bypass the binary result processing, which fails on text stored by earlier versions
+        return lambda value: self.process_result_value(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            # plain JSON text, e.g. stored by an earlier version in a text column
+            return json.loads(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            if value.startswith(COMPRESSED):
+                value = zlib.decompress(value[len(COMPRESSED):])
+            return json.loads(value.decode('utf-8'))
+        # already decoded by the driver
+        return value
+
+
+class RawJSONDocument(JSONDocument):
+    """
+    Column type reading JSON documents as RawJSON text without decoding them, for passing them on as is
+    """
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return RawJSON(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            if value.startswith(COMPRESSED):
+                value = zlib.decompress(value[len(COMPRESSED):])
+            return RawJSON(value.decode('utf-8'))
+        # decoded by the driver
+        return RawJSON(json_dumps(value))
+
+
+class json_text(FunctionElement):
+    """
+    A JSON document column selected as RawJSON text. JSONB documents are cast to text on PostgreSQL, so that the
+    driver doesn't decode them.
+    """
+
+    type = RawJSONDocument()
+    name = 'json_text'
+
+
+@compiles(json_text)
+def _compile_json_text(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)
+
+
+@compiles(json_text, 'postgresql')
+def _compile_json_text_postgresql(element, compiler, **kw):
+    return 'CAST({} AS TEXT)'.format(compiler.process(element.clauses, **kw))
@@ -1,6 +1,13 @@
 from datetime import datetime
+import logging
+from threading import Thread
+from unittest import mock
+import time
+import uuid
 
 import jsonschema
+from dateutil import parser, tz
+from sqlalchemy import event
 
 from slamon_afm.models import db, Agent, AgentCapability, Task
 from slamon_afm.tests.afm_test import AFMTest
@@ -29,6 +36,9 @@ class TestPolling(AFMTest):
             },
             'return_time': {
                 'type': 'string'
+            },
+            'capabilities_hash': {
+                'type': 'string'
             }
         },
         'required': ['tasks', 'return_time'],
@@ -71,7 +81,7 @@ class TestPolling(AFMTest):
         task.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546013'
         task.type = 'task-type-1'
         task.version = 1
-        task.data = "{}"
+        task.data = {}
         db.session.add(task)
         db.session.commit()
 
@@ -93,6 +103,37 @@ class TestPolling(AFMTest):
         jsonschema.validate(resp.json, TestPolling.task_request_response_schema)
         self.assertEqual(len(resp.json['tasks']), 1)
 
+    def test_poll_tasks_payload_logging(self):
+        """Test that task payloads are logged only when enabled."""
+
+        def poll():
+            self.test_app.post_json('/task', {
+                'task_id': str(uuid.uuid4()),
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'task-type-1',
+                'task_version': 1,
+                'task_data': {'secret': 1}
+            })
+
+            with self.assertLogs('slamon_afm', logging.DEBUG) as logs:
+                resp = self.test_app.post_json('/tasks', {
+                    'protocol': 1,
+                    'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                    'agent_name': 'Agent 007',
+                    'agent_time': '2012-04-23T18:25:43.511Z',
+                    'agent_capabilities': {
+                        'task-type-1': {'version': 1}
+                    },
+                    'max_tasks': 5
+                })
+            self.assertEqual(len(resp.json['tasks']), 1)
+            return ' '.join(logs.output)
+
+        self.assertNotIn('secret', poll())
+
+        self.app.config['LOG_PAYLOADS'] = True
+        self.assertIn('secret', poll())
+
     def test_poll_task_capability_change(self):
         self.test_app.post_json('/tasks', {
             'protocol': 1,
@@ -140,6 +181,132 @@ class TestPolling(AFMTest):
         self.assertEqual(db.session.query(AgentCapability).filter(AgentCapability.agent_uuid == agent.uuid). \
                          filter(AgentCapability.type == 'task-type-4').one().version, 4)
 
+    def test_poll_capabilities_unchanged(self):
+        request = {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'agent_name': 'Agent 007',
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {
+                'task-type-1': {'version': 1},
+                'task-type-2': {'version': 2}
+            },
+            'max_tasks': 5
+        }
+        resp = self.test_app.post_json('/tasks', request)
+        self.assertEqual(resp.json['capabilities_hash'],
+                         Agent.capabilities_fingerprint(request['agent_capabilities']))
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.test_app.post_json('/tasks', request)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertFalse([statement for statement in statements if 'agent_capabilities' in statement])
+
+    def test_poll_location_stored(self):
+        request = {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'agent_name': 'Agent 007',
+            'agent_location': {
+                'country': 'FI',
+                'region': '18',
+                'latitude': 60.17,
+                'longitude': 24.94
+            },
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {
+                'task-type-1': {'version': 1}
+            },
+            'max_tasks': 5
+        }
+        self.test_app.post_json('/tasks', request)
+
+        agent = db.session.query(Agent).one()
+        self.assertEqual((agent.country, agent.region, agent.latitude, agent.longitude), ('FI', '18', 60.17, 24.94))
+        self.assertEqual(agent.location_keys(), ['', 'FI', 'FI-18', '@'])
+
+        # an unchanged location is not written again
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.test_app.post_json('/tasks', request)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertFalse([statement for statement in statements if statement.startswith('UPDATE agents')])
+
+    def test_poll_heartbeat_buffered(self):
+        request = {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'agent_name': 'Agent 007',
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {
+                'task-type-1': {'version': 1}
+            },
+            'max_tasks': 5
+        }
+        self.test_app.post_json('/tasks', request)
+        db.session.query(Agent).update({Agent.last_seen: datetime(2015, 1, 1)})
+        db.session.commit()
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.test_app.post_json('/tasks', request)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertFalse([statement for statement in statements if statement.startswith('UPDATE agents')])
+
+        # readers flush the buffered heartbeats
+        self.assertEqual(self.test_app.get('/status').json['agents'], 1)
+        self.assertGreater(db.session.query(Agent).one().last_seen, datetime(2015, 1, 1))
+
+    def test_poll_capabilities_hash_only(self):
+        request = {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'agent_name': 'Agent 007',
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {
+                'task-type-1': {'version': 1}
+            },
+            'max_tasks': 5
+        }
+
+        # Fingerprint not known yet
+        request['agent_capabilities_hash'] = Agent.capabilities_fingerprint(request.pop('agent_capabilities'))
+        assert self.test_app.post_json('/tasks', request, expect_errors=True).status_int == 409
+
+        request['agent_capabilities'] = {'task-type-1': {'version': 1}}
+        capabilities_hash = self.test_app.post_json('/tasks', request).json['capabilities_hash']
+        del request['agent_capabilities']
+
+        task = Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546014', test_id='de305d54-75b4-431b-adb2-eb6b9e546013',
+                    type='task-type-1', version=1, data={})
+        db.session.add(task)
+        db.session.commit()
+        self.app.extensions['pending_tasks'].rebuild()
+
+        request['agent_capabilities_hash'] = capabilities_hash
+        resp = self.test_app.post_json('/tasks', request)
+        jsonschema.validate(resp.json, TestPolling.task_request_response_schema)
+        self.assertEqual(len(resp.json['tasks']), 1)
+        # the capability set was looked up from memory
+        self.assertEqual(self.app.extensions['capability_sets'].stats()['hits'], 1)
+
+        # Neither capabilities nor fingerprint
+        del request['agent_capabilities_hash']
+        assert self.test_app.post_json('/tasks', request, expect_errors=True).status_int == 400
+
     def test_poll_tasks_invalid_data(self):
         # Invalid protocol
         assert self.test_app.post_json('/tasks', {
@@ -278,6 +445,187 @@ class TestPolling(AFMTest):
         }, expect_errors=True).status_int == 400
 
 
+class TestLongPolling(AFMTest):
+    AFM_CONFIG = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'AGENT_LONG_POLL_TIMEOUT': 1
+    }
+
+    poll_request = {
+        'protocol': 1,
+        'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+        'agent_name': 'Agent 007',
+        'agent_time': '2012-04-23T18:25:43.511Z',
+        'agent_capabilities': {
+            'task-type-1': {'version': 1}
+        },
+        'max_tasks': 5,
+        'long_poll': True
+    }
+
+    def test_long_poll_timeout(self):
+        start = time.monotonic()
+        resp = self.test_app.post_json('/tasks', self.poll_request)
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+        self.assertEqual(len(resp.json['tasks']), 0)
+
+    def test_long_poll_wakeup(self):
+        self.app.config['AGENT_LONG_POLL_TIMEOUT'] = 10
+        responses = []
+        poller = Thread(target=lambda: responses.append(self.test_app.post_json('/tasks', self.poll_request)))
+
+        start = time.monotonic()
+        poller.start()
+        time.sleep(0.2)
+
+        # a task of another type should not wake up the agent
+        self.test_app.post_json('/task', {
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'task-type-2',
+            'task_version': 1
+        })
+        self.test_app.post_json('/task', {
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546015',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'task-type-1',
+            'task_version': 1,
+            'task_data': {}
+        })
+        poller.join()
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual([task['task_id'] for task in responses[0].json['tasks']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546015'])
+
+
+    def test_wakeup_by_location(self):
+        notifier = self.app.extensions['task_notifier']
+        snapshot = notifier.snapshot([('task-type-1', 1)], ['', 'FI', 'FI-18'])
+
+        # tasks targeting other locations don't wake up the agent
+        notifier.notify('task-type-1', 1, 'SE')
+        notifier.notify('task-type-1', 1, 'FI-19')
+        self.assertFalse(notifier.wait(snapshot, 0))
+
+        notifier.notify('task-type-1', 1, 'FI')
+        self.assertTrue(notifier.wait(snapshot, 0))
+
+
+class TestReturnTime(AFMTest):
+    AFM_CONFIG = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'AGENT_RETURN_TIME_JITTER': 0
+    }
+
+    poll_request = {
+        'protocol': 1,
+        'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+        'agent_name': 'Agent 007',
+        'agent_time': '2012-04-23T18:25:43.511Z',
+        'agent_capabilities': {
+            'task-type-1': {'version': 1}
+        },
+        'max_tasks': 1
+    }
+
+    def _return_in(self):
+        resp = self.test_app.post_json('/tasks', self.poll_request)
+        return (parser.parse(resp.json['return_time']) - datetime.now(tz.tzlocal())).total_seconds()
+
+    def test_return_time_by_backlog(self):
+        self.assertAlmostEqual(self._return_in(), 60, delta=1)
+
+        for task_id in ('de305d54-75b4-431b-adb2-eb6b9e546014', 'de305d54-75b4-431b-adb2-eb6b9e546015'):
+            self.test_app.post_json('/task', {
+                'task_id': task_id,
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'task-type-1',
+                'task_version': 1
+            })
+        self.assertAlmostEqual(self._return_in(), 5, delta=1)
+
+        # the agent took the last task
+        self.assertAlmostEqual(self._return_in(), 60, delta=1)
+
+    def test_return_time_by_location(self):
+        for task_id in ('de305d54-75b4-431b-adb2-eb6b9e546014', 'de305d54-75b4-431b-adb2-eb6b9e546015'):
+            self.test_app.post_json('/task', {
+                'task_id': task_id,
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'task-type-1',
+                'task_version': 1,
+                'task_location': {'country': 'SE'}
+            })
+
+        # tasks targeting other countries don't make the agent busy
+        self.assertAlmostEqual(self._return_in(), 60, delta=1)
+
+    def test_return_time_jitter(self):
+        self.app.extensions['poll_scheduler'].jitter = 0.5
+        return_times = [self._return_in() for _ in range(20)]
+        self.assertTrue(all(29 < return_in < 91 for return_in in return_times))
+        self.assertGreater(max(return_times) - min(return_times), 1)
+
+    def test_max_poll_rate(self):
+        self.app.extensions['poll_scheduler'].max_poll_rate = 0.01
+        for i in range(3):
+            db.session.add(Agent(uuid=str(uuid.uuid4()), name='Agent', last_seen=datetime.utcnow()))
+        db.session.commit()
+
+        # the polling agent and 3 others polling at most 0.01 times per second in total
+        self.assertAlmostEqual(self._return_in(), 400, delta=1)
+
+
+class TestPendingTaskCounters(AFMTest):
+    poll_request = {
+        'protocol': 1,
+        'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+        'agent_name': 'Agent 007',
+        'agent_time': '2012-04-23T18:25:43.511Z',
+        'agent_capabilities': {
+            'task-type-1': {'version': 1}
+        },
+        'max_tasks': 5
+    }
+
+    def test_empty_poll_skips_claim(self):
+        with mock.patch.object(Task, 'claim_tasks') as claim_tasks:
+            resp = self.test_app.post_json('/tasks', self.poll_request)
+        self.assertEqual(len(resp.json['tasks']), 0)
+        self.assertFalse(claim_tasks.called)
+
+    def test_counters_follow_posts_and_claims(self):
+        pending_tasks = self.app.extensions['pending_tasks']
+        self.assertFalse(pending_tasks.has_pending([('task-type-1', 1)]))
+
+        self.test_app.post_json('/task', {
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'task-type-1',
+            'task_version': 1,
+            'task_data': {}
+        })
+        self.assertTrue(pending_tasks.has_pending([('task-type-1', 1)]))
+        self.assertFalse(pending_tasks.has_pending([('task-type-1', 2)]))
+
+        resp = self.test_app.post_json('/tasks', self.poll_request)
+        self.assertEqual(len(resp.json['tasks']), 1)
+        self.assertFalse(pending_tasks.has_pending([('task-type-1', 1)]))
+
+    def test_rebuild(self):
+        pending_tasks = self.app.extensions['pending_tasks']
+        self.assertFalse(pending_tasks.has_pending([('task-type-1', 1)]))
+
+        task = Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546014', test_id='de305d54-75b4-431b-adb2-eb6b9e546013',
+                    type='task-type-1', version=1, data={})
+        db.session.add(task)
+        db.session.commit()
+
+        pending_tasks.rebuild()
+        self.assertTrue(pending_tasks.has_pending([('task-type-1', 1)]))
+
+
 class TestPushing(AFMTest):
     def test_push_response_non_json(self):
         assert self.test_app.post('/tasks/response', expect_errors=True).status_int == 400
@@ -329,6 +677,34 @@ class TestPushing(AFMTest):
         assert task.failed is not None
         assert task.error is not None
 
+    def test_push_response_reassigned(self):
+        # the task has been requeued and claimed by another agent after the lease of the first agent expired
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546013', test_id='de305d54-75b4-431b-adb2-eb6b9e546013',
+                            type='task-type-1', version=1, claimed=datetime.utcnow(),
+                            assigned_agent_uuid='de305d54-75b4-431b-adb2-eb6b9e546015'))
+        db.session.commit()
+
+        self.test_app.post_json('/tasks/response', {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_data': {'late': True}
+        }, status=400, expect_errors=True)
+        resp = self.test_app.post_json('/tasks/response/batch', {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+            'responses': [{'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'task_data': {'late': True}}]
+        })
+        self.assertEqual(resp.json['results'][0]['status'], 'invalid')
+
+        self.test_app.post_json('/tasks/response', {
+            'protocol': 1,
+            'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546015',
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_data': {'late': False}
+        })
+        self.assertEqual(db.session.query(Task).one().result_data, {'late': False})
+
     def test_push_response_invalid(self):
         # Invalid task id
         assert self.test_app.post_json('/tasks/response', {
@@ -362,3 +738,100 @@ class TestPushing(AFMTest):
                 'another_key': 5
             }
         }, expect_errors=True).status_int == 400
+
+    def test_push_response_batch(self):
+        for i, claimed in enumerate([True, True, False]):
+            task = Task()
+            task.uuid = 'de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i)
+            task.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546013'
+            task.claimed = datetime.utcnow() if claimed else None
+            db.session.add(task)
+        db.session.commit()
+
+        resp = self.test_app.post_json('/tasks/response/batch', {
+            'protocol': 1,
+            'responses': [
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546010',
+                    'task_data': {'key': 'value'}
+                },
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546011',
+                    'task_error': 'Something went terribly wrong'
+                },
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546012',
+                    'task_data': {}
+                },
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                    'task_data': {}
+                },
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546010',
+                    'task_data': {'key': 'another value'}
+                }
+            ]
+        })
+
+        self.assertEqual([result['status'] for result in resp.json['results']],
+                         ['ok', 'ok', 'invalid', 'unknown', 'invalid'])
+
+        task = db.session.query(Task).filter(Task.uuid == 'de305d54-75b4-431b-adb2-eb6b9e546010').one()
+        self.assertIsNotNone(task.completed)
+        self.assertEqual(task.result_data, {'key': 'value'})
+        self.assertIsNone(task.failed)
+
+        task = db.session.query(Task).filter(Task.uuid == 'de305d54-75b4-431b-adb2-eb6b9e546011').one()
+        self.assertIsNone(task.completed)
+        self.assertIsNotNone(task.failed)
+        self.assertEqual(task.error, 'Something went terribly wrong')
+
+        task = db.session.query(Task).filter(Task.uuid == 'de305d54-75b4-431b-adb2-eb6b9e546012').one()
+        self.assertIsNone(task.completed)
+        self.assertIsNone(task.result_data)
+
+    def test_push_response_batch_finished_concurrently(self):
+        for i in range(3):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i),
+                                test_id='de305d54-75b4-431b-adb2-eb6b9e546013', claimed=datetime.utcnow()))
+        db.session.commit()
+
+        # finish one of the tasks behind the request's back after its task states have been looked up
+        def listener(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE tasks') and not finished:
+                finished.append(statement)
+                conn.connection.execute("UPDATE tasks SET started = ?, error = 'Lease expired' WHERE uuid = ?",
+                                        (str(datetime.utcnow()), 'de305d54-75b4-431b-adb2-eb6b9e546011'))
+
+        finished = []
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            resp = self.test_app.post_json('/tasks/response/batch', {
+                'protocol': 1,
+                'responses': [{'task_id': 'de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i), 'task_data': {'i': i}}
+                              for i in range(3)]
+            })
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertTrue(finished)
+        self.assertEqual([result['status'] for result in resp.json['results']], ['ok', 'invalid', 'ok'])
+        task = db.session.query(Task).filter(Task.uuid == 'de305d54-75b4-431b-adb2-eb6b9e546011').one()
+        self.assertIsNone(task.result_data)
+        self.assertEqual(task.error, 'Lease expired')
+
+    def test_push_response_batch_invalid(self):
+        assert self.test_app.post('/tasks/response/batch', expect_errors=True).status_int == 400
+        assert self.test_app.post_json('/tasks/response/batch', {
+            'protocol': 1,
+            'responses': [
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013'
+                }
+            ]
+        }, expect_errors=True).status_int == 400
+        assert self.test_app.post_json('/tasks/response/batch', {
+            'protocol': 2,
+            'responses': []
+        }, expect_errors=True).status_int == 400
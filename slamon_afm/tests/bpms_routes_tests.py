@@ -1,5 +1,6 @@
-from datetime import datetime
-import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
 
 from slamon_afm.models import db, Task
 from slamon_afm.tests.afm_test import AFMTest
@@ -25,6 +26,52 @@ class TestBMPSRoutes(AFMTest):
             'task_version': 1
         })
 
+    def test_post_task_priority(self):
+        self.test_app.post_json('/task', {
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'wait',
+            'task_version': 1,
+            'task_priority': 5
+        })
+        self.test_app.post_json('/task', {
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'wait',
+            'task_version': 1
+        })
+
+        self.assertEqual(db.session.query(Task).get('de305d54-75b4-431b-adb2-eb6b9e546013').priority, 5)
+        self.assertEqual(db.session.query(Task).get('de305d54-75b4-431b-adb2-eb6b9e546014').priority, 0)
+
+    def test_post_task_location(self):
+        locations = [
+            ('de305d54-75b4-431b-adb2-eb6b9e546013', {'country': 'FI'}),
+            ('de305d54-75b4-431b-adb2-eb6b9e546014', {'country': 'FI', 'region': '18'}),
+            ('de305d54-75b4-431b-adb2-eb6b9e546015', {'latitude': 60.17, 'longitude': 24.94, 'radius': 50.0})
+        ]
+        for task_uuid, location in locations:
+            self.test_app.post_json('/task', {
+                'task_id': task_uuid,
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 1,
+                'task_location': location
+            })
+            self.assertEqual(self.test_app.get('/task/' + task_uuid).json['task_location'], location)
+
+        self.assertEqual(db.session.query(Task).get('de305d54-75b4-431b-adb2-eb6b9e546014').location, 'FI-18')
+
+        for location in ({'region': '18'}, {'latitude': 60.17, 'longitude': 24.94},
+                         {'country': 'FI', 'latitude': 60.17, 'longitude': 24.94, 'radius': 50.0}):
+            assert self.test_app.post_json('/task', {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546016',
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 1,
+                'task_location': location
+            }, expect_errors=True).status_int == 400
+
     def test_post_task_invalid(self):
         assert self.test_app.post_json('/task', expect_errors=True).status_int == 400
 
@@ -62,7 +109,7 @@ class TestBMPSRoutes(AFMTest):
         task1.uuid = 'de305d54-75b4-431b-adb2-eb6b9e546018'
         task1.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546018'
         task1.claimed = datetime.utcnow()
-        task1.data = json.dumps({'wait_time': 123})
+        task1.data = {'wait_time': 123}
         db.session.add(task1)
         db.session.commit()
         db.session.close()
@@ -79,7 +126,7 @@ class TestBMPSRoutes(AFMTest):
         task1.uuid = 'de305d54-75b4-431b-adb2-eb6b9e546018'
         task1.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546018'
         task1.claimed = datetime.utcnow()
-        task1.data = json.dumps({'wait_time': 123})
+        task1.data = {'wait_time': 123}
         db.session.add(task1)
 
         task2 = Task()
@@ -87,7 +134,7 @@ class TestBMPSRoutes(AFMTest):
         task2.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546019'
         task2.claimed = datetime.utcnow()
         task2.completed = datetime.utcnow()
-        task2.result_data = json.dumps({'result': 'epic success'})
+        task2.result_data = {'result': 'epic success'}
         db.session.add(task2)
 
         task3 = Task()
@@ -104,5 +151,229 @@ class TestBMPSRoutes(AFMTest):
         self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546019')
         self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546020')
 
+    def test_pull_task_cached(self):
+        now = datetime.utcnow()
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546018', test_id='de305d54-75b4-431b-adb2-eb6b9e546018',
+                            type='wait', version=1, claimed=now))
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546019', test_id='de305d54-75b4-431b-adb2-eb6b9e546019',
+                            type='wait', version=1, claimed=now, completed=now, result_data={'result': 'success'}))
+        db.session.commit()
+
+        # unfinished tasks are not cached
+        resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546018')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546018', headers={'If-None-Match': resp.etag},
+                          status=304)
+        self.assertEqual(self.app.extensions['task_cache'].stats()['entries'], 0)
+
+        resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546019')
+        self.assertEqual(resp.json['task_result'], {'result': 'success'})
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+
+        # finished tasks are served from memory
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546019').json, resp.json)
+            self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546019', headers={'If-None-Match': resp.etag},
+                              status=304)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+
+        stats = self.test_app.get('/status').json['task_cache']
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (1, 2, 3))
+
+    def test_pull_task_cached_until_purge(self):
+        now = datetime.utcnow()
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546018', test_id='de305d54-75b4-431b-adb2-eb6b9e546018',
+                            type='wait', version=1, claimed=now, completed=now - timedelta(days=2)))
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546019', test_id='de305d54-75b4-431b-adb2-eb6b9e546019',
+                            type='wait', version=1, claimed=now, completed=now - timedelta(hours=23, minutes=30)))
+        db.session.commit()
+        self.app.config['TASK_RETENTION_DAYS'] = 1
+
+        # tasks due to be purged are not cached
+        resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546018')
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=0')
+        self.assertEqual(self.app.extensions['task_cache'].stats()['entries'], 0)
+
+        # other tasks are cached until they are due to be purged
+        resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546019')
+        self.assertLessEqual(resp.cache_control.max_age, 1800)
+        self.assertEqual(self.app.extensions['task_cache'].stats()['entries'], 1)
+
+        # expired entries are not served after the task has been purged by another process
+        db.session.query(Task).delete()
+        db.session.commit()
+        self.app.config['TASK_CACHE_MAX_AGE'] = 0
+        self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546019', status=404)
+
     def test_pull_task_invalid(self):
         assert self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546013', expect_errors=True).status_int == 404
+
+    def test_post_task_batch(self):
+        task1 = Task()
+        task1.uuid = 'de305d54-75b4-431b-adb2-eb6b9e546018'
+        task1.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546018'
+        db.session.add(task1)
+        db.session.commit()
+
+        resp = self.test_app.post_json('/task/batch', [
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 1,
+                'task_data': {
+                    'wait_time': 3600
+                }
+            },
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 'invalid_version'
+            },
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 1
+            },
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546018',
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 1
+            },
+            {
+                'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546015',
+                'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                'task_type': 'wait',
+                'task_version': 1
+            }
+        ])
+
+        self.assertEqual([result['status'] for result in resp.json['results']],
+                         ['ok', 'invalid', 'duplicate', 'duplicate', 'ok'])
+        self.assertEqual(db.session.query(Task).count(), 3)
+        task = db.session.query(Task).filter(Task.uuid == 'de305d54-75b4-431b-adb2-eb6b9e546013').one()
+        self.assertEqual(task.data, {'wait_time': 3600})
+        self.assertIsNotNone(task.created)
+        self.assertTrue(self.app.extensions['pending_tasks'].has_pending([('wait', 1)]))
+
+    def test_post_task_batch_concurrent_insert(self):
+        # insert one of the tasks behind the session's back after the duplicate check
+        def listener(conn, cursor, statement, *args):
+            if statement.startswith('SELECT tasks.uuid') and not inserted:
+                inserted.append(statement)
+                conn.connection.execute('INSERT INTO tasks (uuid, test_id, created) VALUES (?, ?, ?)',
+                                        ('de305d54-75b4-431b-adb2-eb6b9e546014', 'de305d54-75b4-431b-adb2-eb6b9e546018',
+                                         str(datetime.utcnow())))
+                conn.connection.commit()
+
+        inserted = []
+        event.listen(db.engine, 'after_cursor_execute', listener)
+        try:
+            resp = self.test_app.post_json('/task/batch', [
+                {
+                    'task_id': 'de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i),
+                    'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+                    'task_type': 'wait',
+                    'task_version': 1
+                } for i in range(3, 6)
+            ])
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', listener)
+
+        self.assertTrue(inserted)
+        self.assertEqual([result['status'] for result in resp.json['results']], ['ok', 'duplicate', 'ok'])
+        self.assertEqual(db.session.query(Task).count(), 3)
+        task = db.session.query(Task).filter(Task.uuid == 'de305d54-75b4-431b-adb2-eb6b9e546014').one()
+        self.assertEqual(task.test_id, 'de305d54-75b4-431b-adb2-eb6b9e546018')
+
+    def test_post_task_batch_invalid(self):
+        assert self.test_app.post_json('/task/batch', expect_errors=True).status_int == 400
+        assert self.test_app.post_json('/task/batch', {
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'wait',
+            'task_version': 1
+        }, expect_errors=True).status_int == 400
+
+    def test_pull_tasks(self):
+        for i in range(5):
+            task = Task()
+            task.uuid = 'de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i)
+            task.test_id = 'de305d54-75b4-431b-adb2-eb6b9e546013' if i < 4 else 'de305d54-75b4-431b-adb2-eb6b9e546014'
+            task.type = 'wait'
+            task.version = 1
+            task.data = {'wait_time': i}
+            if i == 1:
+                task.claimed = datetime.utcnow()
+                task.completed = datetime.utcnow()
+                task.result_data = {'result': 'epic success'}
+            db.session.add(task)
+        db.session.commit()
+
+        # by test id, two tasks per page
+        resp = self.test_app.get('/task', {'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'limit': 2})
+        self.assertEqual([task['task_id'] for task in resp.json['tasks']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546010', 'de305d54-75b4-431b-adb2-eb6b9e546011'])
+        self.assertEqual(resp.json['tasks'][1]['task_result'], {'result': 'epic success'})
+        self.assertEqual(resp.json['tasks'][1],
+                         self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546011').json)
+
+        resp = self.test_app.get('/task', {'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'limit': 2,
+                                           'after': resp.json['next']})
+        self.assertEqual([task['task_id'] for task in resp.json['tasks']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546012', 'de305d54-75b4-431b-adb2-eb6b9e546013'])
+
+        resp = self.test_app.get('/task', {'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'limit': 2,
+                                           'after': resp.json['next']})
+        self.assertEqual(resp.json['tasks'], [])
+        self.assertIsNone(resp.json['next'])
+
+        # by task ids
+        resp = self.test_app.get('/task?task_id=de305d54-75b4-431b-adb2-eb6b9e546014'
+                                 '&task_id=de305d54-75b4-431b-adb2-eb6b9e546012'
+                                 '&task_id=de305d54-75b4-431b-adb2-eb6b9e546019')
+        self.assertEqual([task['task_id'] for task in resp.json['tasks']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546012', 'de305d54-75b4-431b-adb2-eb6b9e546014'])
+        self.assertIsNone(resp.json['next'])
+
+    def test_pull_tasks_single_query(self):
+        for i in range(5):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i),
+                                test_id='de305d54-75b4-431b-adb2-eb6b9e546013', type='wait', version=1,
+                                data={'wait_time': i}, claimed=datetime.utcnow(), completed=datetime.utcnow(),
+                                result_data={'result': i}))
+        db.session.commit()
+        db.session.remove()
+
+        # the task data is loaded with the tasks instead of one query per task
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statement.startswith('SELECT') and \
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            resp = self.test_app.get('/task', {'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013'})
+            self.assertEqual([task['task_result'] for task in resp.json['tasks']], [{'result': i} for i in range(5)])
+            self.assertEqual(len(statements), 1)
+
+            del statements[:]
+            resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546012')
+            self.assertEqual(resp.json['task_data'], {'wait_time': 2})
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+    def test_pull_tasks_invalid(self):
+        assert self.test_app.get('/task', expect_errors=True).status_int == 400
+        assert self.test_app.get('/task', {'test_id': 'invalid'}, expect_errors=True).status_int == 400
+        assert self.test_app.get('/task', {'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'limit': 0},
+                                 expect_errors=True).status_int == 400
+        assert self.test_app.get('/task', {'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'limit': 'many'},
+                                 expect_errors=True).status_int == 400
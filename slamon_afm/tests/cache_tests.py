@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+from slamon_afm.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_entry_limit(self):
+        cache = LRUCache(2, 1000)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 10)
+
+        # least recently used entry is evicted
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        cache = LRUCache(10, 100)
+        cache.put('a', 1, 60)
+        cache.put('b', 2, 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+        # too large values are not cached at all
+        cache.put('c', 3, 101)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.stats()['bytes'], 60)
+
+    def test_stats(self):
+        cache = LRUCache(10, 100)
+        self.assertIsNone(cache.stats()['hit_rate'])
+        cache.put('a', 1, 10)
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.stats(), {'entries': 1, 'bytes': 10, 'hits': 1, 'misses': 1, 'evictions': 0,
+                                         'hit_rate': 0.5})
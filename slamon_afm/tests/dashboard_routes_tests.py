@@ -1,8 +1,27 @@
+from datetime import datetime
+
 import jsonschema
+from sqlalchemy import event
 
+from slamon_afm.models import db, Agent, Task
 from slamon_afm.tests.agent_routes_tests import AFMTest
 
 
+class TestDevRoutesUncached(AFMTest):
+    AFM_CONFIG = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'DASHBOARD_CACHE_TTL': 0
+    }
+
+    def test_get_tasks_streamed(self):
+        db.session.add(Agent(uuid='de305d54-75b4-431b-adb2-eb6b9e546010', name='Agent 007'))
+        db.session.commit()
+
+        resp = self.test_app.get('/dashboard/status')
+        self.assertNotIn('ETag', resp.headers)
+        self.assertEqual(resp.json['agents'][0]['agent_name'], 'Agent 007')
+
+
 class TestDevRoutes(AFMTest):
     task_list_response_schema = {
         'type': 'object',
@@ -54,3 +73,62 @@ class TestDevRoutes(AFMTest):
     def test_get_tasks(self):
         resp = self.test_app.get('/dashboard/status')
         jsonschema.validate(resp.json, TestDevRoutes.task_list_response_schema)
+
+    def test_get_tasks_paginated(self):
+        for i in range(3):
+            db.session.add(Agent(uuid='de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i), name='Agent {}'.format(i)))
+        for i in range(4):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54602{}'.format(i),
+                                test_id='de305d54-75b4-431b-adb2-eb6b9e546013', type='wait', version=1,
+                                assigned_agent_uuid='de305d54-75b4-431b-adb2-eb6b9e546010',
+                                claimed=datetime(2015, 1, 1, 12, i), result_data={'result': i}))
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546030', test_id='de305d54-75b4-431b-adb2-eb6b9e546013',
+                            type='wait', version=1))
+        db.session.commit()
+
+        resp = self.test_app.get('/dashboard/status', {'limit': 2, 'tasks': 3})
+        self.assertEqual([task['task_id'] for task in resp.json['tasks']], ['de305d54-75b4-431b-adb2-eb6b9e546030'])
+        self.assertEqual([agent['agent_id'] for agent in resp.json['agents']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546010', 'de305d54-75b4-431b-adb2-eb6b9e546011'])
+        self.assertEqual([task['task_id'] for task in resp.json['agents'][0]['tasks']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546023', 'de305d54-75b4-431b-adb2-eb6b9e546022',
+                          'de305d54-75b4-431b-adb2-eb6b9e546021'])
+        # results are not included in the listing
+        self.assertNotIn('task_result', resp.json['agents'][0]['tasks'][0])
+        self.assertEqual(resp.json['agents'][1]['tasks'], [])
+
+        next_url = resp.headers['Link'].split(';')[0].strip('<>')
+        resp = self.test_app.get(next_url)
+        self.assertEqual(resp.json['tasks'], [])
+        self.assertEqual([agent['agent_id'] for agent in resp.json['agents']],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546012'])
+        self.assertNotIn('Link', resp.headers)
+
+    def test_get_tasks_invalid(self):
+        assert self.test_app.get('/dashboard/status', {'limit': 'all'}, expect_errors=True).status_int == 400
+        assert self.test_app.get('/dashboard/status', {'limit': 100000}, expect_errors=True).status_int == 400
+        assert self.test_app.get('/dashboard/status', {'tasks': -1}, expect_errors=True).status_int == 400
+
+    def test_get_tasks_conditional(self):
+        resp = self.test_app.get('/dashboard/status')
+        etag = resp.headers['ETag']
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            resp = self.test_app.get('/dashboard/status', headers={'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(resp.status_int, 304)
+        self.assertEqual(statements, [])
+
+        # changed snapshot gets a new tag once the cached one has expired
+        db.session.add(Agent(uuid='de305d54-75b4-431b-adb2-eb6b9e546010', name='Agent 007'))
+        db.session.commit()
+        self.app.extensions['dashboard_cache'].invalidate()
+
+        resp = self.test_app.get('/dashboard/status', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_int, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(resp.json['agents']), 1)
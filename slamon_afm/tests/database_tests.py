@@ -0,0 +1,76 @@
+from unittest import TestCase
+import os.path
+import shutil
+import tempfile
+
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+
+from slamon_afm.app import DefaultConfig, create_app
+from slamon_afm.database import engine_options
+from slamon_afm.models import db
+
+
+def _config(**config):
+    defaults = {key: value for key, value in vars(DefaultConfig).items() if key.isupper()}
+    return dict(defaults, **config)
+
+
+class TestEngineOptions(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database_uri = 'sqlite:///' + os.path.join(self.tmp_dir, 'afm.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _pragmas(self, config):
+        app = create_app(config=dict(config, SQLALCHEMY_DATABASE_URI=self.database_uri))
+        with app.app_context():
+            try:
+                return db.engine, {name: db.engine.execute('PRAGMA ' + name).scalar()
+                                   for name in ('journal_mode', 'synchronous', 'busy_timeout')}
+            finally:
+                db.session.remove()
+
+    def test_sqlite_file(self):
+        engine, pragmas = self._pragmas({})
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.pool.size(), 5)
+        # synchronous = NORMAL
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000})
+
+    def test_sqlite_file_configured(self):
+        engine, pragmas = self._pragmas({'DATABASE_POOL_SIZE': 2, 'SQLITE_JOURNAL_MODE': 'DELETE',
+                                         'SQLITE_SYNCHRONOUS': None, 'SQLITE_BUSY_TIMEOUT': 100})
+        self.assertEqual(engine.pool.size(), 2)
+        # synchronous = FULL by default
+        self.assertEqual(pragmas, {'journal_mode': 'delete', 'synchronous': 2, 'busy_timeout': 100})
+
+    def test_explicit_engine_options(self):
+        app = create_app(config={'SQLALCHEMY_DATABASE_URI': self.database_uri,
+                                 'SQLALCHEMY_ENGINE_OPTIONS': {'pool_size': 3}})
+        with app.app_context():
+            self.assertEqual(db.engine.pool.size(), 3)
+
+        app = create_app(config={'SQLALCHEMY_DATABASE_URI': self.database_uri,
+                                 'SQLALCHEMY_ENGINE_OPTIONS': {'poolclass': NullPool}})
+        with app.app_context():
+            self.assertIsInstance(db.engine.pool, NullPool)
+
+    def test_sqlite_memory(self):
+        options = engine_options(_config(SQLALCHEMY_DATABASE_URI='sqlite://'))
+        self.assertNotIn('poolclass', options)
+        self.assertEqual(options['sqlite_pragmas'], [('busy_timeout', 5000), ('synchronous', 'NORMAL')])
+
+        app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        with app.app_context():
+            self.assertIsInstance(db.engine.pool, StaticPool)
+
+    def test_postgresql(self):
+        options = engine_options(_config(SQLALCHEMY_DATABASE_URI='postgresql+psycopg2://afm@localhost/afm'))
+        self.assertEqual(options, {'pool_pre_ping': True})
+
+        options = engine_options(_config(SQLALCHEMY_DATABASE_URI='postgresql+psycopg2://afm@localhost/afm',
+                                         DATABASE_POOL_SIZE=20, DATABASE_MAX_OVERFLOW=0,
+                                         DATABASE_POOL_PRE_PING=False))
+        self.assertEqual(options, {'pool_size': 20, 'max_overflow': 0, 'pool_pre_ping': False})
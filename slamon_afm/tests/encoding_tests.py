@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+
+import slamon_afm.encoding
+from slamon_afm.encoding import RawJSON, json_dumps, msgpack, cbor2
+from slamon_afm.models import db, Task
+from slamon_afm.tests.afm_test import AFMTest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TASK_REQUEST = {
+    'protocol': 1,
+    'agent_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+    'agent_name': 'Agent 007',
+    'agent_time': '2012-04-23T18:25:43.511Z',
+    'agent_capabilities': {
+        'wait': {'version': 1}
+    },
+    'max_tasks': 5
+}
+
+
+class TestBinaryEncodings(AFMTest):
+    def setUp(self):
+        super().setUp()
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546014',
+                            test_id='de305d54-75b4-431b-adb2-eb6b9e546014',
+                            type='wait', version=1, data={'wait_time': 3600}))
+        db.session.commit()
+
+    def test_json_default(self):
+        resp = self.test_app.post_json('/tasks', TASK_REQUEST)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.json['tasks'][0]['task_data'], {'wait_time': 3600})
+
+    @unittest.skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        headers = {'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'}
+        resp = self.test_app.post('/tasks', msgpack.packb(TASK_REQUEST), headers=headers)
+        self.assertEqual(resp.content_type, 'application/msgpack')
+        tasks = msgpack.unpackb(resp.body, raw=False)['tasks']
+        self.assertEqual(tasks[0]['task_data'], {'wait_time': 3600})
+
+        self.test_app.post('/tasks/response', msgpack.packb({
+            'protocol': 1,
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546014',
+            'task_data': {'result': 'success'}
+        }), headers=headers)
+
+        resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546014',
+                                 headers={'Accept': 'application/msgpack'})
+        self.assertEqual(msgpack.unpackb(resp.body, raw=False)['task_result'], {'result': 'success'})
+
+        # cached responses are kept apart by encoding
+        resp = self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546014')
+        self.assertEqual(resp.json['task_result'], {'result': 'success'})
+
+    @unittest.skipUnless(cbor2, 'cbor2 is not installed')
+    def test_cbor(self):
+        resp = self.test_app.post('/task/batch', cbor2.dumps([{
+            'task_id': 'de305d54-75b4-431b-adb2-eb6b9e546015',
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546015',
+            'task_type': 'wait',
+            'task_version': 1
+        }]), headers={'Content-Type': 'application/cbor', 'Accept': 'application/cbor'})
+        self.assertEqual(cbor2.loads(resp.body)['results'][0]['status'], 'ok')
+
+    @unittest.skipUnless(msgpack, 'msgpack is not installed')
+    def test_invalid(self):
+        # validation is the same for all encodings
+        request = dict(TASK_REQUEST, max_tasks='five')
+        resp = self.test_app.post('/tasks', msgpack.packb(request), headers={'Content-Type': 'application/msgpack'},
+                                  expect_errors=True)
+        self.assertEqual(resp.status_int, 400)
+        resp = self.test_app.post('/tasks', b'\xc1', headers={'Content-Type': 'application/msgpack'},
+                                  expect_errors=True)
+        self.assertEqual(resp.status_int, 400)
+
+    def test_unsupported_encoding(self):
+        encodings = dict(slamon_afm.encoding.BINARY_ENCODINGS, **{'application/cbor': None})
+        with mock.patch.object(slamon_afm.encoding, 'BINARY_ENCODINGS', encodings):
+            resp = self.test_app.post('/tasks', b'\xa0', headers={'Content-Type': 'application/cbor'},
+                                      expect_errors=True)
+        self.assertEqual(resp.status_int, 415)
+
+
+class TestRawJSON(AFMTest):
+    def test_splice(self):
+        self.assertEqual(json_dumps({'tasks': [{'task_id': 'a', 'task_data': RawJSON('{"wait_time":3600}')}]}),
+                         '{"tasks":[{"task_id":"a","task_data":{"wait_time":3600}}]}')
+
+    def test_task_data_passed_as_is(self):
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546014',
+                            test_id='de305d54-75b4-431b-adb2-eb6b9e546014',
+                            type='wait', version=1, data={'wait_time': 3600}))
+        db.session.commit()
+        db.session.expunge_all()
+
+        self.assertEqual(db.session.query(Task).one().data_json, RawJSON('{"wait_time":3600}'))
+        self.assertIn(b'"task_data":{"wait_time":3600}', self.test_app.post_json('/tasks', TASK_REQUEST).body)
+
+    @unittest.skipUnless(orjson, 'orjson is not installed')
+    def test_pluggable_encoder(self):
+        self.app.extensions['json_dumps'] = orjson.dumps
+        self.assertEqual(json_dumps({'task_data': RawJSON('{"a":1}'), 'b': [1, 2]}), '{"task_data":{"a":1},"b":[1,2]}')
@@ -0,0 +1,21 @@
+from unittest import TestCase
+import logging
+import threading
+
+from slamon_afm import logs
+from slamon_afm.app import create_app
+
+
+class TestSetupLogging(TestCase):
+    def test_one_listener_per_process(self):
+        threads = threading.active_count()
+        apps = [create_app(config={'LOG_LEVEL': logging.WARNING}) for _ in range(3)]
+        for app in apps:
+            app.logger.warning('Logged by %s', app)
+
+        # one listener thread at most, started by the first record
+        self.assertLessEqual(threading.active_count(), threads + 1)
+        self.assertEqual(len(logs._handlers), 1)
+        self.assertEqual(logs._listener.handlers, logs._handlers)
+        self.assertEqual(len([handler for handler in apps[-1].logger.handlers
+                              if isinstance(handler, logs.ProcessQueueHandler)]), 1)
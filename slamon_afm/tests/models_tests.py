@@ -0,0 +1,230 @@
+from datetime import datetime
+from unittest import TestCase
+from multiprocessing import Process, Queue
+import logging
+import os.path
+import shutil
+import tempfile
+import uuid
+
+from sqlalchemy import inspect
+from webtest import TestApp
+
+from slamon_afm.app import create_app
+from slamon_afm.models import db, Agent, Task, upgrade_tables
+from slamon_afm.tests.afm_test import AFMTest
+
+
+def _add_tasks(count, task_type='task-type-1', task_version=1):
+    task_uuids = [str(uuid.uuid4()) for _ in range(count)]
+    for task_uuid in task_uuids:
+        db.session.add(Task(uuid=task_uuid, test_id=task_uuid, type=task_type, version=task_version, data={}))
+    db.session.commit()
+    return task_uuids
+
+
+# polling workers give up after this many failed polls in a row
+MAX_CONSECUTIVE_FAILURES = 100
+
+
+def _poll_until_empty(database_uri, agent_uuid, results):
+    """
+    Worker process polling tasks from an AFM instance until there are no more tasks available, or until
+    MAX_CONSECUTIVE_FAILURES polls in a row have failed.
+    """
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': database_uri,
+        'AUTO_CREATE': False,
+        'LOG_LEVEL': logging.WARNING
+    })
+    test_app = TestApp(app)
+
+    claimed = []
+    failures = 0
+    while failures < MAX_CONSECUTIVE_FAILURES:
+        resp = test_app.post_json('/tasks', {
+            'protocol': 1,
+            'agent_id': agent_uuid,
+            'agent_name': 'Agent ' + agent_uuid,
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {
+                'task-type-1': {'version': 1}
+            },
+            'max_tasks': 3
+        }, expect_errors=True)
+        if resp.status_int != 200:
+            # database was locked by another worker for too long, try again
+            failures += 1
+            continue
+        failures = 0
+        if not resp.json['tasks']:
+            break
+        claimed.extend(task['task_id'] for task in resp.json['tasks'])
+
+    results.put((claimed, failures))
+
+
+class TestClaimTasks(AFMTest):
+    def test_claim_tasks(self):
+        task_uuids = _add_tasks(3)
+        agent = Agent.get_agent('de305d54-75b4-431b-adb2-eb6b9e546013', 'Agent 007')
+        agent.update_capabilities({'task-type-1': {'version': 1}})
+
+        claimed = list(Task.claim_tasks(agent, 2))
+        db.session.commit()
+
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(db.session.query(Task).filter(Task.assigned_agent_uuid == agent.uuid).count(), 2)
+        self.assertEqual(db.session.query(Task).filter(Task.claimed.isnot(None)).count(), 2)
+        self.assertTrue(all(task.uuid in task_uuids for task in claimed))
+
+    def test_claim_tasks_in_priority_order(self):
+        tasks = [('task-type-1', 0, 1), ('task-type-1', 5, 3), ('task-type-2', 5, 2), ('task-type-2', 0, 0),
+                 ('task-type-1', -1, 4)]
+        for i, (task_type, priority, minute) in enumerate(tasks):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54602{}'.format(i), test_id=str(uuid.uuid4()),
+                                type=task_type, version=1, data={}, priority=priority,
+                                created=datetime(2015, 1, 1, 12, minute)))
+        db.session.commit()
+        agent = Agent.get_agent('de305d54-75b4-431b-adb2-eb6b9e546013', 'Agent 007')
+        agent.update_capabilities({'task-type-1': {'version': 1}, 'task-type-2': {'version': 1}})
+
+        claimed = [task.uuid for task in Task.claim_tasks(agent, 4)]
+        self.assertEqual(claimed, ['de305d54-75b4-431b-adb2-eb6b9e546022', 'de305d54-75b4-431b-adb2-eb6b9e546021',
+                                   'de305d54-75b4-431b-adb2-eb6b9e546023', 'de305d54-75b4-431b-adb2-eb6b9e546020'])
+
+    def test_claim_tasks_by_location(self):
+        locations = [
+            ('', None), ('FI', None), ('FI-18', None), ('FI-19', None), ('SE', None),
+            ('@', (60.17, 24.94, 50.0)), ('@', (61.50, 23.76, 50.0))
+        ]
+        for i, (location, target) in enumerate(locations):
+            task = Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54602{}'.format(i), test_id=str(uuid.uuid4()),
+                        type='task-type-1', version=1, data={}, location=location)
+            if target:
+                task.target_latitude, task.target_longitude, task.target_radius = target
+            db.session.add(task)
+        db.session.commit()
+
+        agent = Agent.get_agent('de305d54-75b4-431b-adb2-eb6b9e546013', 'Agent 007')
+        agent.update_capabilities({'task-type-1': {'version': 1}})
+        self.assertEqual([task.uuid for task in Task.claim_tasks(agent, 10)],
+                         ['de305d54-75b4-431b-adb2-eb6b9e546020'])
+
+        # Espoo is within 50 km of Helsinki but not of Tampere
+        agent = Agent.get_agent('de305d54-75b4-431b-adb2-eb6b9e546014', 'Agent 008')
+        agent.update_capabilities({'task-type-1': {'version': 1}})
+        agent.update_location({'country': 'fi', 'region': '18', 'latitude': 60.21, 'longitude': 24.66})
+        self.assertEqual(sorted(task.uuid for task in Task.claim_tasks(agent, 10)),
+                         ['de305d54-75b4-431b-adb2-eb6b9e546021', 'de305d54-75b4-431b-adb2-eb6b9e546022',
+                          'de305d54-75b4-431b-adb2-eb6b9e546025'])
+
+    def test_claim_tasks_skips_claimed(self):
+        task_uuids = _add_tasks(2)
+        agent = Agent.get_agent('de305d54-75b4-431b-adb2-eb6b9e546013', 'Agent 007')
+        agent.update_capabilities({'task-type-1': {'version': 1}})
+
+        # Claim one of the tasks behind the session's back
+        db.session.query(Task).filter(Task.uuid == task_uuids[0]). \
+            update({Task.assigned_agent_uuid: 'de305d54-75b4-431b-adb2-eb6b9e546014'}, synchronize_session=False)
+
+        claimed = list(Task.claim_tasks(agent, 5))
+        self.assertEqual([task.uuid for task in claimed], [task_uuids[1]])
+
+
+class TestUpgradeTables(AFMTest):
+    def test_upgrade_tables(self):
+        # Simulate a database created by an earlier version
+        db.drop_all()
+        db.engine.execute('CREATE TABLE agents (uuid CHAR(36) NOT NULL PRIMARY KEY, name VARCHAR NOT NULL, '
+                          'last_seen DATETIME)')
+        db.engine.execute("INSERT INTO agents (uuid, name) VALUES ('de305d54-75b4-431b-adb2-eb6b9e546013', 'Agent')")
+
+        upgrade_tables()
+
+        inspector = inspect(db.engine)
+        self.assertIn('capabilities_hash', [column['name'] for column in inspector.get_columns('agents')])
+        self.assertIn('ix_agents_last_seen', [index['name'] for index in inspector.get_indexes('agents')])
+        self.assertIn('ix_tasks_pending_by_location', [index['name'] for index in inspector.get_indexes('tasks')])
+        self.assertEqual(db.session.query(Agent).one().name, 'Agent')
+
+        # upgrading an up to date database changes nothing
+        upgrade_tables()
+
+        # indexes replaced by others are dropped
+        db.engine.execute('CREATE INDEX ix_tasks_pending ON tasks (type, version)')
+        db.engine.execute('CREATE INDEX ix_tasks_pending_priority ON tasks (type, version, priority DESC, created)')
+        db.engine.execute('CREATE INDEX ix_tasks_pending_location ON tasks (type, version, location, priority DESC, '
+                          'created) WHERE assigned_agent_uuid IS NULL')
+        upgrade_tables()
+        indexes = [index['name'] for index in inspect(db.engine).get_indexes('tasks')]
+        self.assertNotIn('ix_tasks_pending', indexes)
+        self.assertNotIn('ix_tasks_pending_priority', indexes)
+        self.assertNotIn('ix_tasks_pending_location', indexes)
+
+    def test_upgrade_tables_archive(self):
+        # Simulate an archive created by an earlier version, before priorities and locations
+        db.drop_all()
+        db.engine.execute('CREATE TABLE tasks_archive (uuid CHAR(36) NOT NULL PRIMARY KEY, test_id CHAR(36) NOT NULL, '
+                          'type VARCHAR, version INTEGER, data BLOB, result_data BLOB, assigned_agent_uuid CHAR(36), '
+                          'created DATETIME NOT NULL, claimed DATETIME, completed DATETIME, started DATETIME, '
+                          'error VARCHAR, lease_expires DATETIME, expires DATETIME, archived DATETIME NOT NULL)')
+        db.engine.execute("INSERT INTO tasks_archive (uuid, test_id, type, version, created, completed, archived) "
+                          "VALUES ('de305d54-75b4-431b-adb2-eb6b9e546013', 'de305d54-75b4-431b-adb2-eb6b9e546013', "
+                          "'wait', 1, '2015-01-01 12:00:00', '2015-01-01 12:01:00', '2015-02-01 12:00:00')")
+
+        upgrade_tables()
+
+        self.assertEqual(db.engine.execute('SELECT priority, location FROM tasks_archive').fetchall(), [(0, '')])
+
+    def test_claim_uses_pending_index(self):
+        plan = ' '.join(str(row) for row in db.engine.execute(
+            'EXPLAIN QUERY PLAN SELECT uuid FROM tasks WHERE assigned_agent_uuid IS NULL AND completed IS NULL '
+            "AND started IS NULL AND type = 'task-type-1' AND version = 1 AND location = 'FI-18' "
+            'ORDER BY priority DESC, created LIMIT 5').fetchall())
+        self.assertIn('ix_tasks_pending_by_location', plan)
+        # no sorting of the pending tasks
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class TestConcurrentClaims(TestCase):
+    """
+    Multiple AFM processes sharing a file database must never hand out the same task twice
+    """
+
+    WORKERS = 4
+    TASKS = 60
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database_uri = 'sqlite:///' + os.path.join(self.tmp_dir, 'afm.db')
+
+        self.app = create_app(config={'SQLALCHEMY_DATABASE_URI': self.database_uri})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_no_task_claimed_twice(self):
+        task_uuids = _add_tasks(self.TASKS)
+
+        results = Queue()
+        workers = [Process(target=_poll_until_empty, args=(self.database_uri, str(uuid.uuid4()), results))
+                   for _ in range(self.WORKERS)]
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual([failures for _, failures in outcomes if failures >= MAX_CONSECUTIVE_FAILURES], [],
+                         'Workers gave up after {} failed polls in a row'.format(MAX_CONSECUTIVE_FAILURES))
+        claimed = [task_uuid for task_uuids, _ in outcomes for task_uuid in task_uuids]
+
+        self.assertEqual(len(claimed), len(set(claimed)))
+        self.assertEqual(sorted(claimed), sorted(task_uuids))
+        self.assertEqual(db.session.query(Task).filter(Task.assigned_agent_uuid.is_(None)).count(), 0)
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+from slamon_afm.models import db, Task
+from slamon_afm.tests.afm_test import AFMTest
+
+
+class TestTaskReaper(AFMTest):
+    TASK_UUID = 'de305d54-75b4-431b-adb2-eb6b9e546013'
+
+    def post_task(self, **extra):
+        self.test_app.post_json('/task', dict({
+            'task_id': self.TASK_UUID,
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'wait',
+            'task_version': 1,
+            'task_data': {'wait_time': 3600}
+        }, **extra))
+
+    def poll(self, agent_uuid):
+        return self.test_app.post_json('/tasks', {
+            'protocol': 1,
+            'agent_id': agent_uuid,
+            'agent_name': 'Agent ' + agent_uuid,
+            'agent_time': '2012-04-23T18:25:43.511Z',
+            'agent_capabilities': {'wait': {'version': 1}},
+            'max_tasks': 5
+        }).json['tasks']
+
+    def test_lease_expiry_requeues(self):
+        self.post_task()
+        self.assertEqual(len(self.poll('de305d54-75b4-431b-adb2-eb6b9e546014')), 1)
+
+        task = db.session.query(Task).one()
+        self.assertEqual(task.lease_expires, task.claimed + timedelta(seconds=self.app.config['TASK_LEASE_TIME']))
+
+        # nothing to reap while the lease is valid
+        self.assertEqual(self.app.extensions['task_reaper'].sweep(), (0, 0))
+
+        db.session.query(Task).update({Task.lease_expires: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        self.assertEqual(self.app.extensions['task_reaper'].sweep(), (1, 0))
+
+        task = db.session.query(Task).one()
+        self.assertIsNone(task.assigned_agent_uuid)
+        self.assertIsNone(task.claimed)
+        self.assertIsNone(task.lease_expires)
+
+        # requeued task is counted as pending again and handed out to the next agent
+        self.assertEqual(len(self.poll('de305d54-75b4-431b-adb2-eb6b9e546015')), 1)
+
+    def test_finished_task_lease_cleared(self):
+        self.post_task()
+        self.poll('de305d54-75b4-431b-adb2-eb6b9e546014')
+        self.test_app.post_json('/tasks/response', {'protocol': 1, 'task_id': self.TASK_UUID, 'task_data': {}})
+
+        self.assertIsNone(db.session.query(Task).one().lease_expires)
+
+    def test_ttl_expiry_fails(self):
+        self.post_task(task_ttl=60)
+        task = db.session.query(Task).one()
+        self.assertGreater(task.expires, datetime.utcnow())
+
+        db.session.query(Task).update({Task.expires: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+        # expired tasks are not handed out even before they are reaped
+        self.assertEqual(self.poll('de305d54-75b4-431b-adb2-eb6b9e546014'), [])
+
+        self.assertEqual(self.app.extensions['task_reaper'].sweep(), (0, 1))
+        resp = self.test_app.get('/task/' + self.TASK_UUID).json
+        self.assertIn('task_failed', resp)
+        self.assertEqual(resp['task_error'], 'Task expired before it was claimed')
+
+        # failed tasks are not pending any more
+        self.assertEqual(self.poll('de305d54-75b4-431b-adb2-eb6b9e546014'), [])
+        self.app.extensions['pending_tasks'].rebuild()
+        self.assertFalse(self.app.extensions['pending_tasks'].has_pending([('wait', 1)]))
+        self.assertEqual(self.test_app.get('/status').json['tasks_waiting'], 0)
+        self.assertEqual(self.test_app.get('/dashboard/status').json['tasks'], [])
+
+    def test_ttl_invalid(self):
+        self.assertEqual(self.test_app.post_json('/task', {
+            'task_id': self.TASK_UUID,
+            'test_id': 'de305d54-75b4-431b-adb2-eb6b9e546013',
+            'task_type': 'wait',
+            'task_version': 1,
+            'task_ttl': 0
+        }, expect_errors=True).status_int, 400)
+
+    def test_sweep_in_batches(self):
+        self.app.extensions['task_reaper'].batch_size = 2
+        past = datetime.utcnow() - timedelta(seconds=1)
+        for i in range(5):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54602{}'.format(i),
+                                test_id='de305d54-75b4-431b-adb2-eb6b9e546013', type='wait', version=1, expires=past))
+        db.session.commit()
+
+        self.assertEqual(self.app.extensions['task_reaper'].sweep(), (0, 5))
+        self.assertEqual(db.session.query(Task).filter(Task.failed.isnot(None)).count(), 5)
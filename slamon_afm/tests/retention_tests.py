@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+from slamon_afm.models import db, Task, tasks_archive
+from slamon_afm.retention import purge_tasks
+from slamon_afm.tests.afm_test import AFMTest
+
+
+class TestRetention(AFMTest):
+    def setUp(self):
+        super().setUp()
+        now = datetime.utcnow()
+        old = now - timedelta(days=10)
+        states = [
+            {'completed': old, 'result_data': {'result': 1}},
+            {'failed': old, 'error': 'Failed'},
+            {'completed': old},
+            {'completed': now},
+            {'claimed': old},
+            {},
+        ]
+        for i, state in enumerate(states):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i),
+                                test_id='de305d54-75b4-431b-adb2-eb6b9e546013', type='wait', version=1, **state))
+        db.session.commit()
+
+    def remaining(self):
+        return sorted(task_uuid for task_uuid, in db.session.query(Task.uuid))
+
+    def test_archive(self):
+        self.assertEqual(purge_tasks(7, batch_size=2), 3)
+
+        self.assertEqual(self.remaining(), ['de305d54-75b4-431b-adb2-eb6b9e546013',
+                                            'de305d54-75b4-431b-adb2-eb6b9e546014',
+                                            'de305d54-75b4-431b-adb2-eb6b9e546015'])
+        archived = {row.uuid: row for row in db.session.execute(tasks_archive.select())}
+        self.assertEqual(sorted(archived), ['de305d54-75b4-431b-adb2-eb6b9e546010',
+                                            'de305d54-75b4-431b-adb2-eb6b9e546011',
+                                            'de305d54-75b4-431b-adb2-eb6b9e546012'])
+        self.assertEqual(archived['de305d54-75b4-431b-adb2-eb6b9e546010'].result_data, {'result': 1})
+        self.assertEqual(archived['de305d54-75b4-431b-adb2-eb6b9e546011'].error, 'Failed')
+        self.assertIsNotNone(archived['de305d54-75b4-431b-adb2-eb6b9e546011'].archived)
+
+        # archived tasks are no longer served
+        self.test_app.get('/task/de305d54-75b4-431b-adb2-eb6b9e546010', status=404)
+
+    def test_delete(self):
+        self.assertEqual(purge_tasks(7, archive=False), 3)
+
+        self.assertEqual(len(self.remaining()), 3)
+        self.assertEqual(db.session.execute(tasks_archive.count()).scalar(), 0)
+
+    def test_nothing_to_purge(self):
+        self.assertEqual(purge_tasks(30), 0)
+        self.assertEqual(len(self.remaining()), 6)
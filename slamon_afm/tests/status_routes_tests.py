@@ -1,9 +1,11 @@
+from datetime import datetime, timedelta
 from unittest import TestCase
 
 from webtest import TestApp
 
 from slamon_afm.tests.afm_test import AFMTest
 from slamon_afm.app import create_app
+from slamon_afm.models import db, Agent, Task
 
 
 class TestStatusValid(AFMTest):
@@ -13,6 +15,48 @@ class TestStatusValid(AFMTest):
         assert 'agents' in result
         assert 'tasks_waiting' in result
 
+    def test_status_counts(self):
+        now = datetime.utcnow()
+        db.session.add(Agent(uuid='de305d54-75b4-431b-adb2-eb6b9e546013', name='Agent 007', last_seen=now))
+        db.session.add(Agent(uuid='de305d54-75b4-431b-adb2-eb6b9e546014', name='Agent 008',
+                             last_seen=datetime(2015, 1, 1)))
+        # lost just over AGENT_ACTIVE_THRESHOLD ago
+        db.session.add(Agent(uuid='de305d54-75b4-431b-adb2-eb6b9e546015', name='Agent 009',
+                             last_seen=now - timedelta(seconds=self.app.config['AGENT_ACTIVE_THRESHOLD'] + 5)))
+        states = [
+            ('wait', {}),
+            ('wait', {}),
+            ('wait', {'assigned_agent_uuid': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'claimed': now}),
+            ('wait', {'assigned_agent_uuid': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'claimed': now,
+                      'completed': now}),
+            ('ping', {'assigned_agent_uuid': 'de305d54-75b4-431b-adb2-eb6b9e546013', 'claimed': now, 'failed': now}),
+        ]
+        for i, (task_type, state) in enumerate(states):
+            db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e54601{}'.format(i),
+                                test_id='de305d54-75b4-431b-adb2-eb6b9e546013', type=task_type, version=1, **state))
+        db.session.commit()
+
+        result = self.test_app.get('/status').json
+
+        self.assertEqual(result['agents'], 1)
+        self.assertEqual(result['tasks_waiting'], 2)
+        self.assertEqual(result['tasks'], {'pending': 2, 'claimed': 1, 'completed': 1, 'failed': 1})
+        self.assertEqual(result['task_types'], [
+            {'task_type': 'ping', 'task_version': 1, 'pending': 0, 'claimed': 0, 'completed': 0, 'failed': 1},
+            {'task_type': 'wait', 'task_version': 1, 'pending': 2, 'claimed': 1, 'completed': 1, 'failed': 0}
+        ])
+
+    def test_status_cached(self):
+        self.assertEqual(self.test_app.get('/status').json['tasks_waiting'], 0)
+
+        db.session.add(Task(uuid='de305d54-75b4-431b-adb2-eb6b9e546013', test_id='de305d54-75b4-431b-adb2-eb6b9e546013',
+                            type='wait', version=1))
+        db.session.commit()
+        self.assertEqual(self.test_app.get('/status').json['tasks_waiting'], 0)
+
+        self.app.extensions['status_cache'].invalidate()
+        self.assertEqual(self.test_app.get('/status').json['tasks_waiting'], 1)
+
 
 class TestStatusSQLProblem(TestCase):
     """
@@ -0,0 +1,71 @@
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+
+from slamon_afm.encoding import RawJSON
+from slamon_afm.models import db, Task
+from slamon_afm.storage import COMPRESSED
+from slamon_afm.tests.afm_test import AFMTest
+
+
+class TestJSONDocument(AFMTest):
+    TASK_UUID = 'de305d54-75b4-431b-adb2-eb6b9e546013'
+
+    def add_task(self, data):
+        db.session.add(Task(uuid=self.TASK_UUID, test_id=self.TASK_UUID, type='wait', version=1, data=data))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def raw_data(self):
+        return db.engine.execute('SELECT data FROM tasks').scalar()
+
+    def test_small_document(self):
+        self.add_task({'wait_time': 3600})
+
+        self.assertEqual(self.raw_data(), b'{"wait_time":3600}')
+        self.assertEqual(db.session.query(Task).one().data, {'wait_time': 3600})
+
+    def test_large_document_compressed(self):
+        data = {'output': 'x' * 10000}
+        self.add_task(data)
+
+        raw = self.raw_data()
+        self.assertTrue(raw.startswith(COMPRESSED))
+        self.assertLess(len(raw), 1000)
+        self.assertEqual(db.session.query(Task).one().data, data)
+
+    def test_compression_threshold(self):
+        self.app.config['TASK_DATA_COMPRESS_THRESHOLD'] = 0
+        self.add_task({'output': 'x' * 10000})
+
+        self.assertFalse(self.raw_data().startswith(COMPRESSED))
+
+    def test_legacy_text(self):
+        self.add_task(None)
+        db.engine.execute("UPDATE tasks SET data = '{\"wait_time\": 3600}'")
+
+        self.assertEqual(db.session.query(Task).one().data, {'wait_time': 3600})
+
+    def test_payload_loaded_lazily(self):
+        self.add_task({'wait_time': 3600})
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            task = db.session.query(Task).one()
+            self.assertFalse([statement for statement in statements if 'tasks.data' in statement])
+            self.assertEqual(task.data, {'wait_time': 3600})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertTrue([statement for statement in statements if 'tasks.data' in statement])
+
+    def test_raw_json(self):
+        self.add_task({'wait_time': 3600})
+
+        self.assertEqual(db.session.query(Task.data_json).scalar(), RawJSON('{"wait_time":3600}'))
+
+    def test_raw_json_not_decoded_on_postgresql(self):
+        # JSONB documents are selected as text, the driver would decode them otherwise
+        statement = str(db.session.query(Task.data_json).statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('CAST(tasks.data AS TEXT)', statement)
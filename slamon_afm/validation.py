@@ -0,0 +1,13 @@
+from jsonschema.validators import validator_for
+
+
+def compile_schema(schema):
+    """
+    Check a JSON schema once and build a reusable validator for it
+
+    :param schema: The JSON schema
+    :return: A validator instance, its validate() raises jsonschema.ValidationError for invalid data
+    """
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)